@@ -4,21 +4,57 @@ load_dotenv()
 import os
 import logging
 
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
 from flask import Flask, request, jsonify
-from services import UserService, PaymentService, USSDHandler
-from db import db
+from services import DEADLINE_RESPONSE, UserService, PaymentService, USSDHandler
+from storage import create_user_store
 from config import Config
-
-logging.basicConfig(level=logging.INFO)
+from deadline import request_deadline
+from tokens import TokenRefresher
+from dispatch import PaymentDispatcher
+from reconciler import PendingReconciler
+from event_loop import EventLoopThread
+from async_services import create_async_ussd_handler
+from logs import HOP_LOGGER, MaskedPhone, setup_logging
+from metrics import REGISTRY, hop_timer, label_hop
+from tracing import configure_tracing, start_span
+
+setup_logging()
+configure_tracing()
 logger = logging.getLogger(__name__)
+hop_logger = logging.getLogger(HOP_LOGGER)
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = Config.SECRET_KEY
 
 # Initialize services
-db_service = UserService(db)
+db_service = UserService(create_user_store())
 payment_service = PaymentService()
-ussd_handler = USSDHandler(db_service, payment_service)
+payment_dispatcher = PaymentDispatcher(Config.PAYMENT_WORKERS) if Config.PAYMENT_ASYNC else None
+ussd_handler = USSDHandler(db_service, payment_service, dispatcher=payment_dispatcher)
+
+ussd_loop = None
+async_ussd_handler = None
+if Config.USSD_ASYNC:
+    ussd_loop = EventLoopThread('ussd-async')
+    ussd_loop.start()
+    async_ussd_handler = ussd_loop.run(create_async_ussd_handler(db_service, payment_service))
+
+token_refresher = None
+if Config.IOTEC_TOKEN_REFRESHER:
+    token_refresher = TokenRefresher(payment_service)
+    token_refresher.start()
+    REGISTRY.register_gauges('iotec_token_refresher', "Background ioTec token refresher state",
+                             token_refresher.stats)
+
+if Config.METRICS_DIR:
+    REGISTRY.start_flusher(Config.METRICS_DIR, Config.METRICS_FLUSH_INTERVAL)
+
+reconciler = None
+if Config.RECONCILE_INTERVAL > 0:
+    reconciler = PendingReconciler(db_service, payment_service)
+    reconciler.start()
 
 
 @app.route('/ussd', methods=['POST'])
@@ -30,20 +66,43 @@ def handle_ussd():
         phone_number = request.form.get('phoneNumber', '')
         text = request.form.get('text', '')
 
-        logger.info(f"USSD Request - Session: {session_id}, Phone: {phone_number}, Text: '{text}'")
-
-        response = ussd_handler.handle_ussd_request(phone_number, text)
-        formatted_response = f"{response['response_type']} {response['message']}"
-
-        logger.info(f"USSD Response - Session: {session_id}, Response: '{formatted_response[:100]}...'")
+        hop_logger.info("USSD Request - Session: %s, Phone: %s, Text: '%s'",
+                        session_id, MaskedPhone(phone_number), text, extra={'session_id': session_id})
+
+        with start_span('ussd.request', session_id=session_id) as span, hop_timer(), \
+                request_deadline(Config.USSD_DEADLINE_SECONDS) as deadline:
+            if async_ussd_handler:
+                try:
+                    response = ussd_loop.run(
+                        async_ussd_handler.handle_ussd_request(phone_number, text, session_id),
+                        timeout=deadline.remaining())
+                except FuturesTimeoutError:
+                    response = DEADLINE_RESPONSE
+            else:
+                response = ussd_handler.handle_ussd_request(phone_number, text, session_id)
+            label_hop(response_type=response['response_type'])
+            if span:
+                span.set_attribute('response_type', response['response_type'])
+        # Static menu screens come with their wire string pre-rendered
+        formatted_response = response.get('wire') or f"{response['response_type']} {response['message']}"
+
+        hop_logger.info("USSD Response - Session: %s, Response: '%.100s...'",
+                        session_id, formatted_response, extra={'session_id': session_id})
 
         return formatted_response
 
     except Exception as e:
-        logger.error(f"USSD endpoint error: {e}")
+        logger.error("USSD endpoint error: %s", e)
         return "END Service error. Please try again later."
 
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus metrics, aggregated over all workers"""
+    body = REGISTRY.render(Config.METRICS_DIR, stale_after=3 * Config.METRICS_FLUSH_INTERVAL)
+    return body, 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
 @app.route('/admin/user/<phone>', methods=['GET'])
 def get_user_info(phone):
     """Admin endpoint to get user information"""
@@ -55,7 +114,7 @@ def get_user_info(phone):
             return jsonify({'error': 'User not found'}), 404
 
     except Exception as e:
-        logger.error(f"Admin get user error: {e}")
+        logger.error("Admin get user error: %s", e)
         return jsonify({'error': 'Internal server error'}), 500
 
 
@@ -67,10 +126,51 @@ def check_payment_status(transaction_id):
         return jsonify(result), 200
 
     except Exception as e:
-        logger.error(f"Admin payment status error: {e}")
+        logger.error("Admin payment status error: %s", e)
         return jsonify({'error': 'Status check failed'}), 500
 
 
+@app.route('/payments/iotec/callback', methods=['POST'])
+def iotec_payment_callback():
+    """ioTec Pay collection status notification"""
+    try:
+        signature = request.headers.get(Config.IOTEC_WEBHOOK_SIGNATURE_HEADER, '')
+        if not payment_service.verify_webhook_signature(request.get_data(), signature):
+            return jsonify({'error': 'Invalid signature'}), 401
+
+        payload = request.get_json(silent=True) or {}
+        transaction_id = payload.get('id', '')
+        external_id = payload.get('externalId', '')
+        phone = payment_service.phone_from_external_id(external_id)
+
+        user = db_service.get_user(phone) if phone else None
+        # A collection whose answer was lost is known only by its externalId
+        adopt = bool(user and not user.get('transaction_id')
+                     and user.get('external_id') == external_id)
+        if not user or not transaction_id or (user.get('transaction_id') != transaction_id
+                                              and not adopt):
+            return jsonify({'error': 'Unknown transaction'}), 404
+
+        if user['status'] == 'registered':
+            return jsonify({'status': user['status']}), 200
+
+        # Intermediate notifications (e.g. Processing) must not fail the user
+        status = payment_service.map_known_status(payload.get('status'))
+        if status is None and not adopt:
+            return jsonify({'status': user['status']}), 200
+
+        status = status or user['status']
+        if not db_service.update_user_status(phone, status,
+                                             transaction_id if adopt else None):
+            return jsonify({'error': 'Update failed'}), 500
+
+        return jsonify({'status': status}), 200
+
+    except Exception as e:
+        logger.error("ioTec callback error: %s", e)
+        return jsonify({'error': 'Internal server error'}), 500
+
+
 if __name__ == '__main__':
     # Development server
     app.run(host='0.0.0.0', port=int(os.getenv('PORT', 5000)), debug=True)
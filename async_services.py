@@ -0,0 +1,446 @@
+import asyncio
+import inspect
+import logging
+
+import httpx
+
+from typing import Optional, Dict, Any
+from datetime import datetime
+from config import Config
+from deadline import DeadlineExceeded, call_timeout, current_deadline, ensure_budget
+from resilience import CircuitBreaker, RetryPolicy, may_have_been_processed
+from services import BasePaymentService, BaseUserService, UserService, USSDHandler, User
+from sessions import SessionStore
+from tokens import SharedTokenCache
+from dispatch import AsyncPaymentDispatcher
+from idempotency import IdempotencyStore
+from logs import MaskedPhone
+from menu import Outcome
+from metrics import IOTEC_SECONDS, USER_STORE_SECONDS, label_hop
+from tracing import traced
+from storage import AsyncUserStore, create_async_user_store
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class AsyncUserService(BaseUserService):
+    """UserService for the async USSD path"""
+    def __init__(self, store: AsyncUserStore):
+        super().__init__(store)
+
+    @traced
+    async def get_user(self, phone: str) -> Optional[Dict[str, Any]]:
+        """Retrieve user by phone number"""
+        try:
+            timeout = call_timeout(Config.FIRESTORE_TIMEOUT, Config.USSD_MIN_CALL_BUDGET)
+            with USER_STORE_SECONDS.time('get'):
+                return await self.store.get(phone, timeout=timeout)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.error("Error getting user %s: %s", MaskedPhone(phone), e)
+            # A lookup that timed out with the budget spent is not "no user"
+            ensure_budget(Config.USSD_MIN_CALL_BUDGET)
+            return None
+
+    @traced
+    async def save_user(self, user_data: Dict[str, Any]) -> bool:
+        """Save or update user data"""
+        try:
+            phone = user_data['phone']
+            user_data['updated_at'] = datetime.now().isoformat()
+
+            # Writes record payment outcomes, so the hop's deadline does not cut them short
+            with USER_STORE_SECONDS.time('set'):
+                await self.store.set(phone, user_data, merge=True, timeout=Config.FIRESTORE_TIMEOUT)
+            logger.info("User %s saved successfully", MaskedPhone(phone))
+            return True
+        except Exception as e:
+            logger.error("Error saving user: %s", e)
+            return False
+
+    @traced
+    async def delete_user(self, phone: str) -> bool:
+        """Delete user from database"""
+        try:
+            timeout = call_timeout(Config.FIRESTORE_TIMEOUT, Config.USSD_MIN_CALL_BUDGET)
+            with USER_STORE_SECONDS.time('delete'):
+                await self.store.delete(phone, timeout=timeout)
+            logger.info("User %s deleted successfully", MaskedPhone(phone))
+            return True
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.error("Error deleting user %s: %s", MaskedPhone(phone), e)
+            return False
+
+    @traced
+    async def update_user_status(self, phone: str, status: str, transaction_id: Optional[str] = None,
+                                 external_id: Optional[str] = None) -> bool:
+        """Update user status and transaction ID"""
+        try:
+            with USER_STORE_SECONDS.time('update'):
+                await self.store.update(phone, self.status_update(status, transaction_id, external_id),
+                                        timeout=Config.FIRESTORE_TIMEOUT)
+            logger.info("User %s status updated to %s", MaskedPhone(phone), status)
+            return True
+        except Exception as e:
+            logger.error("Error updating user status: %s", e)
+            return False
+
+
+class AsyncPaymentService(BasePaymentService):
+    """Handle ioTec Pay payment operations as coroutines.
+
+    All calls share one HTTP/2 client, so concurrent status checks are
+    multiplexed over a single connection per host. With a shared token
+    cache, tokens refreshed by other processes (or the blocking service's
+    TokenRefresher) are adopted before requesting a new one; unlike the
+    blocking service, refreshes do not take the host-wide lock, which
+    would block the event loop.
+    """
+    def __init__(self, client: Optional[httpx.AsyncClient] = None,
+                 breaker: Optional[CircuitBreaker] = None,
+                 retry: Optional[RetryPolicy] = None,
+                 shared_tokens: Optional[SharedTokenCache] = None):
+        super().__init__(breaker, retry, shared_tokens)
+        self._token_lock = asyncio.Lock()
+        self.client = client or self.create_client()
+
+    @staticmethod
+    def create_client() -> httpx.AsyncClient:
+        limits = httpx.Limits(max_connections=Config.IOTEC_POOL_MAXSIZE,
+                              max_keepalive_connections=Config.IOTEC_POOL_MAXSIZE)
+        return httpx.AsyncClient(http2=True, limits=limits)
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Call ioTec with deadline-bounded timeouts and retries, feeding the
+        circuit breaker"""
+        attempt = 0
+        while True:
+            connect, read = self.request_timeout(method, url)
+            timeout = httpx.Timeout(read, connect=connect)
+            try:
+                with IOTEC_SECONDS.time(self.endpoint_name(url)):
+                    response = await self.client.request(method, url, timeout=timeout, **kwargs)
+                    response.raise_for_status()
+            except Exception as e:
+                self.record_outcome(e)
+                delay = self.retry_delay(attempt, e, self.is_idempotent(method, url))
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+
+            self.record_outcome()
+            return response
+
+    @traced
+    async def get_access_token(self) -> Optional[str]:
+        """Get OAuth2 access token from ioTec Pay, refreshing single-flight"""
+        # Check if token is still valid (with 30 seconds buffer)
+        access_token = self.cached_token()
+        if access_token:
+            return access_token
+
+        if self._token_lock.locked():
+            access_token = self.cached_token(buffer=0)
+            if access_token:
+                return access_token
+
+        deadline = current_deadline()
+        try:
+            await asyncio.wait_for(self._token_lock.acquire(),
+                                   deadline.remaining() if deadline else None)
+        except asyncio.TimeoutError:
+            logger.error("Timed out waiting for access token refresh")
+            return None
+
+        try:
+            access_token = self.cached_token()
+            if access_token:
+                return access_token
+            if self.shared_tokens and self.adopt_shared_token():
+                return self.access_token
+
+            access_token = await self.refresh_access_token()
+            if access_token and self.shared_tokens:
+                self.shared_tokens.write(*self.token)
+            return access_token
+        finally:
+            self._token_lock.release()
+
+    @traced
+    async def refresh_access_token(self) -> Optional[str]:
+        """Request a new OAuth2 access token from ioTec Pay"""
+        try:
+            response = await self.request('POST', Config.IOTEC_AUTH_URL, **self.token_request())
+            access_token = self.store_token(response.json())
+
+            logger.info("Access token obtained successfully")
+            return access_token
+
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.error("Error getting access token: %s", e)
+            return None
+
+    @traced
+    async def initiate_collection(self, phone: str, amount: int, external_id: str,
+                                  payer_note: str = "", payee_note: str = "") -> Dict[str, Any]:
+        """Initiate mobile money collection"""
+        ensure_budget(Config.USSD_MIN_CALL_BUDGET)
+        if not self.breaker.allow_request():
+            logger.warning("Payment circuit open, skipping collection")
+            return {'success': False, 'message': 'Payment service unavailable'}
+
+        try:
+            access_token = await self.get_access_token()
+            if not access_token:
+                return {'success': False, 'message': 'Authentication failed'}
+
+            headers = {
+                'Authorization': f'Bearer {access_token}',
+                'Content-Type': 'application/json'
+            }
+
+            # Format phone number to MSISDN format
+            formatted_phone = self.format_phone_number(phone)
+            if not formatted_phone:
+                return {'success': False, 'message': 'Invalid phone number format'}
+
+            payload = self.collection_payload(external_id, amount, payer_note, payee_note)
+
+            response = await self.request('POST', Config.IOTEC_COLLECTION_URL,
+                                          headers=headers, json=payload)
+
+            result = response.json()
+            logger.info("Collection initiated for %s: %s", MaskedPhone(phone), result.get('id', 'N/A'))
+
+            return self.collection_result(result)
+
+        except DeadlineExceeded:
+            raise
+        except httpx.HTTPError as e:
+            if may_have_been_processed(e):
+                logger.warning("Collection for %s has an unknown outcome: %s", MaskedPhone(phone), e)
+                return self.unknown_collection_result()
+            logger.error("Payment API error: %s", e)
+            return {'success': False, 'message': 'Payment service unavailable'}
+        except Exception as e:
+            logger.error("Error initiating collection: %s", e)
+            return {'success': False, 'message': 'Payment initialization failed'}
+
+    @traced
+    async def check_transaction_status(self, transaction_id: str) -> Dict[str, Any]:
+        """Check transaction status from ioTec Pay (cached by transaction_id)"""
+        cached = self.cached_status(transaction_id)
+        if cached:
+            return cached
+
+        result = await self.fetch_transaction_status(transaction_id)
+        self.store_status(transaction_id, result)
+        return dict(result)
+
+    @traced
+    async def fetch_transaction_status(self, transaction_id: str) -> Dict[str, Any]:
+        ensure_budget(Config.USSD_MIN_CALL_BUDGET)
+        if not self.breaker.allow_request():
+            logger.warning("Payment circuit open, skipping status check")
+            return {'success': False, 'message': 'Status check failed'}
+
+        try:
+            access_token = await self.get_access_token()
+            if not access_token:
+                return {'success': False, 'message': 'Authentication failed'}
+
+            headers = {'Authorization': f'Bearer {access_token}'}
+            url = f"{Config.IOTEC_STATUS_URL}/{transaction_id}"
+
+            response = await self.request('GET', url, headers=headers)
+
+            return self.status_result(response.json())
+
+        except DeadlineExceeded:
+            raise
+        except httpx.HTTPError as e:
+            logger.error("Status check API error: %s", e)
+            return {'success': False, 'message': 'Status check failed'}
+        except Exception as e:
+            logger.error("Error checking transaction status: %s", e)
+            return {'success': False, 'message': 'Status check failed'}
+
+
+class AsyncUSSDHandler(USSDHandler):
+    """USSDHandler whose storage and payment I/O are coroutines.
+
+    Only methods that do I/O are overridden; branching and responses come
+    from the USSDHandler helpers they call. The inherited flow and action
+    methods that merely delegate (route, run_menu, register_action, ...)
+    return the coroutines of the overrides they call.
+    """
+    def __init__(self, db_service: AsyncUserService, payment_service: AsyncPaymentService,
+                 session_store: Optional[SessionStore] = None,
+                 dispatcher: Optional[AsyncPaymentDispatcher] = None,
+                 idempotency: Optional[IdempotencyStore] = None):
+        super().__init__(db_service, payment_service, session_store, dispatcher, idempotency)
+
+    async def handle_ussd_request(self, phone_number: str,
+                                  text: str, session_id: str = "") -> Dict[str, str]:
+        """Main USSD request handler"""
+        return self.finish_request(await self._handle_request(phone_number, text, session_id),
+                                   session_id)
+
+    async def load_session(self, phone_number: str, session_id: str) -> Dict[str, Any]:
+        session = self.cached_session(phone_number, session_id)
+        if session is None:
+            session = self.start_session(phone_number, session_id,
+                                         await self.db.get_user(phone_number))
+        return session
+
+    async def _handle_request(self, phone_number: str, text: str,
+                              session_id: str) -> Dict[str, str]:
+        try:
+            response = self.replayed_response(phone_number, session_id)
+            if response:
+                return response
+
+            session = await self.load_session(phone_number, session_id)
+            label_hop(branch=self.branch(session['user']))
+
+            response = self.resume_menu(session, text, session_id)
+            if response is None:
+                response = self.route(phone_number, self.parse_text(text), session['user'], session_id)
+            return await response
+
+        except DeadlineExceeded:
+            return self.deadline_response(phone_number)
+        except Exception as e:
+            return self.error_response(e)
+
+    async def respond(self, outcome: Outcome, data: Dict[str, Any],
+                      user: Optional[Dict], session_id: str = "") -> Dict[str, str]:
+        response = super().respond(outcome, data, user, session_id)
+        # Actions return coroutines, screens plain responses
+        if inspect.isawaitable(response):
+            response = await response
+        return response
+
+    async def restart_action(self, data: Dict[str, Any], user: Optional[Dict],
+                             session_id: str) -> Dict[str, str]:
+        await self.db.delete_user(data['phone'])
+        return self.restart_response()
+
+    async def initiate_payment_for_new_user(self, user: User, session_id: str = "") -> Dict[str, str]:
+        """Initiate payment for new user registration"""
+        if not session_id:
+            return await self.start_new_user_payment(user, session_id)
+        return await self.idempotency.run_async(self.payment_key(user.phone, session_id),
+                                                self.start_new_user_payment, user, session_id)
+
+    async def start_new_user_payment(self, user: User, session_id: str) -> Dict[str, str]:
+        try:
+            if self.dispatcher and not self.payment.is_available():
+                return self.payment_started_response(False)
+            charge = self.registration_charge(user.phone, user.name, session_id)
+            if self.started_in_session(await self.db.get_user(user.phone), session_id, charge):
+                return self.payment_started_response(True)
+            # Record the intent first, so a lost background task, an early
+            # redial or a retry of this hop on another worker finds it
+            saved = await self.db.save_user(self.payment_intent(user.to_dict(), charge))
+            if self.dispatcher:
+                return self.queue_payment(saved, self.collect_new_user_payment, user, charge)
+            return self.payment_started_response(
+                saved and await self.collect_new_user_payment(user, charge))
+
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.error("Error initiating payment for new user: %s", e)
+            return self.create_response("END",
+                "Payment initialization failed. Please try again later.")
+
+    async def collect_new_user_payment(self, user: User, charge: Dict[str, Any]) -> bool:
+        """Request the registration fee and persist the new user with the outcome"""
+        fields = self.collection_fields(await self.payment.initiate_collection(**charge),
+                                        charge['external_id'])
+        await self.db.save_user({**user.to_dict(), **fields})
+        return fields['status'] == 'pending'
+
+    async def retry_payment(self, user: Dict, session_id: str = "") -> Dict[str, str]:
+        """Retry payment for failed registration"""
+        if not session_id:
+            return await self.start_retry_payment(user, session_id)
+        return await self.idempotency.run_async(self.payment_key(user['phone'], session_id),
+                                                self.start_retry_payment, user, session_id)
+
+    async def start_retry_payment(self, user: Dict, session_id: str) -> Dict[str, str]:
+        try:
+            if self.dispatcher and not self.payment.is_available():
+                return self.payment_started_response(False)
+            charge = self.registration_charge(user['phone'], user['name'], session_id, retry=True)
+            if self.started_in_session(await self.db.get_user(user['phone']), session_id, charge):
+                return self.payment_started_response(True)
+            saved = await self.db.save_user(self.payment_intent({'phone': user['phone']}, charge))
+            if self.dispatcher:
+                return self.queue_payment(saved, self.collect_retry_payment, user, charge)
+            return self.payment_started_response(
+                saved and await self.collect_retry_payment(user, charge))
+
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.error("Error retrying payment: %s", e)
+            return self.create_response("END",
+                "Payment retry failed. Please try again later.")
+
+    async def collect_retry_payment(self, user: Dict, charge: Dict[str, Any]) -> bool:
+        """Request the fee again for a failed registration and store the outcome"""
+        fields = self.collection_fields(await self.payment.initiate_collection(**charge),
+                                        charge['external_id'])
+        await self.db.update_user_status(user['phone'], **fields)
+        return fields['status'] == 'pending'
+
+    async def confirm_payment(self, user: Dict) -> Dict[str, str]:
+        """Confirm pending payment status"""
+        try:
+            response = self.unpolled_payment_response(user)
+            if response:
+                return response
+
+            status = self.checked_status(
+                await self.payment.check_transaction_status(user['transaction_id']))
+            if status:
+                await self.db.update_user_status(user['phone'], status)
+            return self.checked_payment_response(user, status)
+
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.error("Error confirming payment: %s", e)
+            return self.create_response("END",
+                "Payment confirmation failed. Please try again later.")
+
+
+async def create_async_ussd_handler(user_service: UserService,
+                                    payment_service: Optional[BasePaymentService] = None
+                                    ) -> AsyncUSSDHandler:
+    """Build the async USSD stack on the event loop that will run it.
+
+    The user store, ioTec circuit breaker and shared token cache are
+    shared with the blocking services used by the admin, webhook
+    and reconciler paths.
+    """
+    db_service = AsyncUserService(create_async_user_store(user_service.store))
+    breaker = payment_service.breaker if payment_service else None
+    shared_tokens = payment_service.shared_tokens if payment_service else None
+    dispatcher = AsyncPaymentDispatcher() if Config.PAYMENT_ASYNC else None
+    return AsyncUSSDHandler(db_service,
+                            AsyncPaymentService(breaker=breaker, shared_tokens=shared_tokens),
+                            dispatcher=dispatcher)
@@ -0,0 +1,62 @@
+import threading
+
+from typing import Any, Dict, Hashable, Optional, Tuple
+from cachetools import LRUCache, TTLCache
+
+
+class CountingCache:
+    """Thread-safe bounded cache with hit/miss counters.
+
+    Entries expire after ``ttl`` seconds (never if ``ttl`` is None); the
+    least recently used entry is evicted once ``maxsize`` is reached. ``version()`` lets a reader detect
+    an invalidation that raced with its backend fetch.
+    """
+    def __init__(self, maxsize: int, ttl: Optional[float]):
+        if ttl is None:
+            self._cache = LRUCache(maxsize=maxsize)
+        else:
+            self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def version(self) -> int:
+        return self._version
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """Return (found, value) for key"""
+        with self._lock:
+            try:
+                value = self._cache[key]
+            except KeyError:
+                self.misses += 1
+                return False, None
+            self.hits += 1
+            return True, value
+
+    def set(self, key: Hashable, value: Any, version: Optional[int] = None) -> None:
+        """Store value; skipped if an invalidation happened since ``version``"""
+        with self._lock:
+            if version is not None and version != self._version:
+                return
+            self._cache[key] = value
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._version += 1
+            self._cache.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._version += 1
+            self._cache.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'size': len(self._cache),
+                'maxsize': int(self._cache.maxsize),
+                'hits': self.hits,
+                'misses': self.misses
+            }
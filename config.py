@@ -10,3 +10,102 @@ class Config:
     FIREBASE_SERVICE_ACCOUNT_B64 = os.getenv("FIREBASE_SERVICE_ACCOUNT_B64")
     WALLET_ID = os.getenv('WALLET_ID')
     INQUIRY_PHONE = "0200947464"
+
+    # User storage backend: firestore, memory or sqlite
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'firestore')
+    SQLITE_PATH = os.getenv('SQLITE_PATH', 'ussd.db')
+    SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', 5))
+
+    # Keep-alive connection pool for ioTec Pay (one pool per host)
+    IOTEC_POOL_CONNECTIONS = int(os.getenv('IOTEC_POOL_CONNECTIONS', 4))
+    IOTEC_POOL_MAXSIZE = int(os.getenv('IOTEC_POOL_MAXSIZE', 32))
+
+    # Africa's Talking drops sessions that do not answer within a few seconds
+    USSD_DEADLINE_SECONDS = float(os.getenv('USSD_DEADLINE_SECONDS', 4))
+    IOTEC_CONNECT_TIMEOUT = float(os.getenv('IOTEC_CONNECT_TIMEOUT', 2))
+    IOTEC_READ_TIMEOUT = float(os.getenv('IOTEC_READ_TIMEOUT', 5))
+    FIRESTORE_TIMEOUT = float(os.getenv('FIRESTORE_TIMEOUT', 3))
+    # No remote call is started with less than this left of the deadline
+    USSD_MIN_CALL_BUDGET = float(os.getenv('USSD_MIN_CALL_BUDGET', 0.5))
+
+    # Serve /ussd from one event loop per worker with async Firestore and
+    # ioTec clients; request threads only wait for the result
+    USSD_ASYNC = os.getenv('USSD_ASYNC', 'false').lower() in ('1', 'true', 'yes')
+
+    # Optional background renewal of the ioTec token at a fraction of expires_in;
+    # with USSD_ASYNC the async client only sees it via IOTEC_SHARED_TOKEN_PATH
+    IOTEC_TOKEN_REFRESHER = os.getenv('IOTEC_TOKEN_REFRESHER', 'false').lower() in ('1', 'true', 'yes')
+    IOTEC_TOKEN_REFRESH_FRACTION = float(os.getenv('IOTEC_TOKEN_REFRESH_FRACTION', 0.8))
+    IOTEC_TOKEN_RETRY_INTERVAL = float(os.getenv('IOTEC_TOKEN_RETRY_INTERVAL', 10))
+
+    # File shared by all workers on a host so only one of them fetches the
+    # ioTec token; empty disables sharing
+    IOTEC_SHARED_TOKEN_PATH = os.getenv('IOTEC_SHARED_TOKEN_PATH', '')
+    IOTEC_SHARED_TOKEN_LOCK_TIMEOUT = float(os.getenv('IOTEC_SHARED_TOKEN_LOCK_TIMEOUT', 10))
+
+    # ioTec collection status notifications; confirm_payment polls only when
+    # the stored status is older than the grace period
+    IOTEC_WEBHOOK_SECRET = os.getenv('IOTEC_WEBHOOK_SECRET')
+    IOTEC_WEBHOOK_SIGNATURE_HEADER = os.getenv('IOTEC_WEBHOOK_SIGNATURE_HEADER', 'X-Iotec-Signature')
+    IOTEC_WEBHOOK_GRACE_SECONDS = float(os.getenv('IOTEC_WEBHOOK_GRACE_SECONDS', 600))
+
+    # Retries of transient ioTec errors, only while the deadline allows
+    IOTEC_RETRY_ATTEMPTS = int(os.getenv('IOTEC_RETRY_ATTEMPTS', 3))
+    IOTEC_RETRY_BASE_DELAY = float(os.getenv('IOTEC_RETRY_BASE_DELAY', 0.1))
+    IOTEC_RETRY_MAX_DELAY = float(os.getenv('IOTEC_RETRY_MAX_DELAY', 1))
+    IOTEC_RETRY_MIN_BUDGET = float(os.getenv('IOTEC_RETRY_MIN_BUDGET', 1))
+
+    # Circuit breaker around ioTec collection and status calls
+    IOTEC_BREAKER_WINDOW = int(os.getenv('IOTEC_BREAKER_WINDOW', 20))
+    IOTEC_BREAKER_MIN_CALLS = int(os.getenv('IOTEC_BREAKER_MIN_CALLS', 10))
+    IOTEC_BREAKER_FAILURE_RATE = float(os.getenv('IOTEC_BREAKER_FAILURE_RATE', 0.5))
+    IOTEC_BREAKER_RESET_TIMEOUT = float(os.getenv('IOTEC_BREAKER_RESET_TIMEOUT', 30))
+
+    # Transaction status cache: terminal results are kept (LRU-bounded),
+    # pending ones only briefly
+    STATUS_CACHE_MAXSIZE = int(os.getenv('STATUS_CACHE_MAXSIZE', 10000))
+    STATUS_CACHE_PENDING_TTL = float(os.getenv('STATUS_CACHE_PENDING_TTL', 15))
+
+    # Initiate collections on a background pool instead of inside the hop
+    PAYMENT_ASYNC = os.getenv('PAYMENT_ASYNC', 'false').lower() in ('1', 'true', 'yes')
+    PAYMENT_WORKERS = int(os.getenv('PAYMENT_WORKERS', 8))
+    # A pending record without a transaction id is reported as in progress
+    # for this long, then treated as a lost background task
+    PAYMENT_INTENT_TIMEOUT = float(os.getenv('PAYMENT_INTENT_TIMEOUT', 120))
+
+    # Window in which a repeated payment hop of one session replays the
+    # original result instead of firing another mobile money prompt. The
+    # store is per worker; a retry served by another worker is caught by
+    # the pending record and externalId saved before the collection
+    IDEMPOTENCY_MAXSIZE = int(os.getenv('IDEMPOTENCY_MAXSIZE', 10000))
+    IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', 300))
+
+    # Background reconciliation of pending transactions; 0 disables it
+    RECONCILE_INTERVAL = float(os.getenv('RECONCILE_INTERVAL', 0))
+    RECONCILE_BATCH_SIZE = int(os.getenv('RECONCILE_BATCH_SIZE', 100))
+    RECONCILE_CONCURRENCY = int(os.getenv('RECONCILE_CONCURRENCY', 8))
+    RECONCILE_LOCK_PATH = os.getenv('RECONCILE_LOCK_PATH', '/tmp/ussd_reconcile.lock')
+
+    # Per-session user snapshots (Africa's Talking sessions last < 3 minutes),
+    # the only user caching: a per-process cache would serve stale statuses
+    SESSION_MAXSIZE = int(os.getenv('SESSION_MAXSIZE', 50000))
+    SESSION_TTL = float(os.getenv('SESSION_TTL', 300))
+
+    # Logging goes through a queue drained by a background thread; per-hop
+    # request/response lines are kept for this fraction of sessions
+    LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+    LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+    LOG_HOP_SAMPLE_RATE = float(os.getenv('LOG_HOP_SAMPLE_RATE', 1))
+    LOG_MASK_PHONES = os.getenv('LOG_MASK_PHONES', 'true').lower() in ('1', 'true', 'yes')
+
+    # Workers share metrics through per-process snapshot files in this
+    # directory (empty: single process, no files); gunicorn.conf.py folds
+    # the files of exited workers into one aggregate
+    METRICS_DIR = os.getenv('METRICS_DIR', '')
+    METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 10))
+
+    # Request tracing: '' (off), 'memory' (recent spans in-process) or
+    # 'file' (JSON lines at TRACE_FILE)
+    TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', '').lower()
+    TRACE_FILE = os.getenv('TRACE_FILE', 'traces.jsonl')
+    TRACE_MEMORY_MAXSIZE = int(os.getenv('TRACE_MEMORY_MAXSIZE', 1000))
@@ -1,17 +1,26 @@
 import json
-import firebase_admin
 import logging
 import base64
+import threading
 
-from firebase_admin import credentials, firestore
-from google.cloud.firestore import Client
+from typing import TYPE_CHECKING, Optional
 from config import Config
 
+if TYPE_CHECKING:
+    from google.cloud.firestore import AsyncClient, Client
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+_client: Optional['Client'] = None
+_async_client: Optional['AsyncClient'] = None
+_client_lock = threading.Lock()
+
+
+def init_app() -> None:
+    import firebase_admin
+    from firebase_admin import credentials
 
-def init_firebase() -> Client:
     try:
         firebase_admin.get_app()
     except ValueError:
@@ -21,7 +30,52 @@ def init_firebase() -> Client:
         firebase_admin.initialize_app(cred)
         logger.info("Firebase initialized successfully")
 
+
+def init_firebase() -> 'Client':
+    from firebase_admin import firestore
+
+    init_app()
     return firestore.client()
 
 
-db: Client = init_firebase()
+def get_db() -> 'Client':
+    """Firestore client, created on first use"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = init_firebase()
+    return _client
+
+
+def get_async_db() -> 'AsyncClient':
+    """Firestore AsyncClient, created on first use.
+
+    Its gRPC channel belongs to the event loop it is first used on, so all
+    callers must share one loop (see event_loop.EventLoopThread).
+    """
+    global _async_client
+    if _async_client is None:
+        with _client_lock:
+            if _async_client is None:
+                from firebase_admin import firestore_async
+
+                init_app()
+                _async_client = firestore_async.client()
+    return _async_client
+
+
+def warm_up() -> 'Client':
+    """Create the client ahead of the first request.
+
+    Call this after fork (see gunicorn.conf.py) so no gRPC channel is
+    ever created in a process that forks afterwards.
+    """
+    return get_db()
+
+
+def __getattr__(name: str):
+    # Keeps `from db import db` working without initializing at import
+    if name == 'db':
+        return get_db()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,72 @@
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional, Tuple
+
+
+class DeadlineExceeded(Exception):
+    """Raised when the USSD response budget is already spent"""
+
+
+class Deadline:
+    """Absolute point in time by which the current USSD hop must answer"""
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+_current_deadline: ContextVar[Optional[Deadline]] = ContextVar('ussd_deadline', default=None)
+
+
+def current_deadline() -> Optional[Deadline]:
+    return _current_deadline.get()
+
+
+@contextmanager
+def request_deadline(seconds: float) -> Iterator[Deadline]:
+    """Bind a deadline to the current request context"""
+    deadline = Deadline(seconds)
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def http_timeout(connect: float, read: float) -> Tuple[float, float]:
+    """(connect, read) timeout capped by what is left of the current deadline"""
+    deadline = current_deadline()
+    if deadline is None:
+        return connect, read
+
+    remaining = deadline.remaining()
+    if remaining <= 0:
+        raise DeadlineExceeded("USSD deadline exceeded")
+    return min(connect, remaining), min(read, remaining)
+
+
+def call_timeout(default: float, minimum: float = 0.0) -> float:
+    """Timeout for a remote call, capped by the current deadline.
+
+    Raises DeadlineExceeded instead when less than ``minimum`` seconds are
+    left, so no call is started whose answer the gateway would discard.
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return default
+
+    remaining = deadline.remaining()
+    if remaining <= 0 or remaining < minimum:
+        raise DeadlineExceeded("USSD deadline nearly exceeded")
+    return min(default, remaining)
+
+
+def ensure_budget(minimum: float) -> None:
+    """Raise DeadlineExceeded unless ``minimum`` seconds of the deadline remain"""
+    call_timeout(minimum, minimum)
@@ -0,0 +1,70 @@
+import asyncio
+import contextvars
+import logging
+import threading
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Awaitable, Callable, Set
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class PaymentDispatcher:
+    """Run payment initiation on a background thread pool.
+
+    Submitted work lives only in this process; anything still queued when
+    the worker is killed is lost and the user has to redial.
+    """
+    def __init__(self, max_workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix='payment')
+        self._lock = threading.Lock()
+        self.pending = 0
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        with self._lock:
+            self.pending += 1
+        future = self._executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future) -> None:
+        with self._lock:
+            self.pending -= 1
+        error = future.exception()
+        if error:
+            logger.error("Background payment task failed: %s", error)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+
+class AsyncPaymentDispatcher:
+    """Run payment initiation as background tasks on the running event loop.
+
+    Like PaymentDispatcher, queued work is lost if the process dies.
+    """
+    def __init__(self):
+        # The loop only keeps weak references to tasks
+        self._tasks: Set[asyncio.Task] = set()
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    def submit(self, fn: Callable[..., Awaitable], *args, **kwargs) -> asyncio.Task:
+        # A fresh context, so the task outlives the hop's request deadline
+        loop = asyncio.get_running_loop()
+        task = contextvars.Context().run(loop.create_task, fn(*args, **kwargs))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+        return task
+
+    def _done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error:
+            logger.error("Background payment task failed: %s", error)
@@ -0,0 +1,58 @@
+import asyncio
+import logging
+import threading
+
+from concurrent.futures import Future, TimeoutError as FuturesTimeoutError
+from typing import Any, Awaitable, Optional
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class EventLoopThread:
+    """A long-lived asyncio event loop running on a daemon thread.
+
+    Async clients (httpx, the Firestore AsyncClient) are bound to the loop
+    they are used on, so the async USSD path runs every request on this one
+    loop; request threads only submit work and wait for the result.
+    """
+    def __init__(self, name: str = 'event-loop'):
+        self.name = name
+        self.loop = asyncio.new_event_loop()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro: Awaitable, timeout: Optional[float] = None) -> Any:
+        """Run coro on the loop and wait for its result.
+
+        The caller's context variables (such as the request deadline) are
+        visible to the coroutine. On timeout concurrent.futures.TimeoutError
+        is raised but the coroutine is left to finish, like the thread of a
+        sync request, so writes recording a payment are not cut short.
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result(timeout)
+        except FuturesTimeoutError:
+            future.add_done_callback(self._log_abandoned)
+            raise
+
+    @staticmethod
+    def _log_abandoned(future: Future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Abandoned coroutine failed: %s", future.exception())
+
+    def stop(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if self._thread:
+            self._thread.join()
+            self._thread = None
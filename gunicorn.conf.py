@@ -0,0 +1,42 @@
+from dotenv import load_dotenv
+load_dotenv()
+
+import glob
+import os
+import sys
+
+from config import Config
+
+
+def on_starting(server):
+    """Start metrics from zero: drop snapshots of a previous master's workers"""
+    if Config.METRICS_DIR:
+        for path in glob.glob(os.path.join(Config.METRICS_DIR, '*.json')):
+            os.unlink(path)
+
+
+def post_fork(server, worker):
+    """Create the Firestore client in each worker, after the fork"""
+    if Config.STORAGE_BACKEND == 'firestore':
+        import db
+        db.warm_up()
+
+
+def worker_exit(server, worker):
+    """Write the exiting worker's final metrics snapshot"""
+    metrics = sys.modules.get('metrics')
+    if Config.METRICS_DIR and metrics:
+        try:
+            metrics.REGISTRY.flush(Config.METRICS_DIR)
+        except OSError as e:
+            server.log.error("Error writing final metrics snapshot: %s", e)
+
+
+def child_exit(server, worker):
+    """Fold an exited worker's metrics into the aggregate file"""
+    if Config.METRICS_DIR:
+        import metrics
+        try:
+            metrics.retire_snapshot(Config.METRICS_DIR, worker.pid)
+        except (OSError, ValueError) as e:
+            server.log.error("Error retiring metrics of worker %s: %s", worker.pid, e)
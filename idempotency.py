@@ -0,0 +1,87 @@
+import asyncio
+import threading
+
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+from cachetools import TTLCache
+from deadline import current_deadline
+
+
+class IdempotencyStore:
+    """Run an operation at most once per key within a time window.
+
+    Repeats of a finished operation get the stored result; repeats that
+    arrive while the first call is still running wait for it (bounded by
+    the request deadline) instead of starting a second one.
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        self._results = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._in_flight: Dict[Hashable, threading.Event] = {}
+        self._async_in_flight: Dict[Hashable, asyncio.Event] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Tuple[bool, Any]:
+        """Return (found, result) for a completed operation"""
+        with self._lock:
+            if key in self._results:
+                return True, self._results[key]
+            return False, None
+
+    def run(self, key: Hashable, fn: Callable, *args, **kwargs) -> Any:
+        with self._lock:
+            if key in self._results:
+                return self._results[key]
+            event = self._in_flight.get(key)
+            owner = event is None
+            if owner:
+                event = self._in_flight[key] = threading.Event()
+
+        if not owner:
+            deadline = current_deadline()
+            event.wait(deadline.remaining() if deadline else None)
+            found, result = self.get(key)
+            if found:
+                return result
+            # The first call failed or is still running past our budget
+            raise TimeoutError(f"Duplicate operation {key} did not complete")
+
+        try:
+            result = fn(*args, **kwargs)
+            with self._lock:
+                self._results[key] = result
+            return result
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            event.set()
+
+    async def run_async(self, key: Hashable, fn: Callable[..., Awaitable],
+                        *args, **kwargs) -> Any:
+        """Coroutine version of run; callers must share one event loop"""
+        with self._lock:
+            if key in self._results:
+                return self._results[key]
+            event = self._async_in_flight.get(key)
+            owner = event is None
+            if owner:
+                event = self._async_in_flight[key] = asyncio.Event()
+
+        if not owner:
+            deadline = current_deadline()
+            try:
+                await asyncio.wait_for(event.wait(), deadline.remaining() if deadline else None)
+            except asyncio.TimeoutError:
+                pass
+            found, result = self.get(key)
+            if found:
+                return result
+            raise TimeoutError(f"Duplicate operation {key} did not complete")
+
+        try:
+            result = await fn(*args, **kwargs)
+            with self._lock:
+                self._results[key] = result
+            return result
+        finally:
+            with self._lock:
+                self._async_in_flight.pop(key, None)
+            event.set()
@@ -0,0 +1,29 @@
+import fcntl
+import os
+import time
+
+from contextlib import contextmanager
+from typing import Iterator
+
+
+@contextmanager
+def file_lock(path: str, timeout: float) -> Iterator[bool]:
+    """Hold an exclusive host-wide flock on path; yields False if not acquired in time"""
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    acquired = False
+    try:
+        give_up_at = time.monotonic() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                acquired = True
+                break
+            except BlockingIOError:
+                if time.monotonic() >= give_up_at:
+                    break
+                time.sleep(0.05)
+        yield acquired
+    finally:
+        if acquired:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
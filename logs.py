@@ -0,0 +1,93 @@
+import atexit
+import copy
+import logging
+import queue
+import zlib
+
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+from config import Config
+
+# Per-hop request/response lines; sampled by SessionSampler
+HOP_LOGGER = 'ussd.hop'
+
+_listener: Optional[QueueListener] = None
+
+
+class DeferredQueueHandler(QueueHandler):
+    """QueueHandler that leaves message formatting to the listener thread.
+
+    Request threads only enqueue the record, so log arguments are expected
+    not to change after the call (strings, numbers, exceptions). When the
+    queue is full records are dropped and counted rather than blocking.
+    """
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        if record.exc_info:
+            # Tracebacks keep frames alive; render them while they are valid
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class SessionSampler(logging.Filter):
+    """Keep the records of a fixed fraction of USSD sessions.
+
+    The decision hashes the record's ``session_id`` so every hop of a kept
+    session is logged; records without one always pass.
+    """
+    def __init__(self, rate: float):
+        super().__init__()
+        self.threshold = int(max(0.0, min(rate, 1.0)) * 10000)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        session_id = getattr(record, 'session_id', None)
+        if session_id is None or self.threshold >= 10000:
+            return True
+        return zlib.crc32(session_id.encode('utf-8')) % 10000 < self.threshold
+
+
+class MaskedPhone:
+    """Phone number that is only masked if the record is actually formatted"""
+    __slots__ = ('phone',)
+
+    def __init__(self, phone: Optional[str]):
+        self.phone = phone
+
+    def __str__(self) -> str:
+        phone = self.phone or ''
+        if not Config.LOG_MASK_PHONES or len(phone) < 8:
+            return phone
+        return phone[:3] + '*' * (len(phone) - 7) + phone[-4:]
+
+
+def setup_logging() -> None:
+    """Route all logging through a queue drained by a background thread.
+
+    Replaces the handlers installed by the modules' basicConfig calls. The
+    listener thread does not survive fork, so call this in each worker.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    log_queue = queue.Queue(maxsize=Config.LOG_QUEUE_SIZE)
+    logging.basicConfig(level=Config.LOG_LEVEL, handlers=[DeferredQueueHandler(log_queue)],
+                        force=True)
+    logging.getLogger(HOP_LOGGER).addFilter(SessionSampler(Config.LOG_HOP_SAMPLE_RATE))
+
+    _listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
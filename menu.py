@@ -0,0 +1,197 @@
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+from config import Config
+
+
+@dataclass(frozen=True)
+class Option:
+    """What a fixed choice at a state leads to"""
+    next: Optional[str] = None    # state to move to
+    end: Optional[str] = None     # END message
+    action: Optional[str] = None  # USSDHandler action to run
+    value: Any = None             # stored under the state's key
+
+
+@dataclass(frozen=True)
+class State:
+    """One menu screen: its prompt and how an input moves on from it.
+
+    States with ``options`` accept only those inputs and end the session
+    with ``invalid`` otherwise; states without are free text, where an
+    empty input re-prompts and anything else is stored under ``key`` and
+    moves to ``next``. Prompts of ``templated`` states are formatted with the
+    session data.
+    """
+    name: str
+    prompt: str
+    options: Dict[str, Option] = field(default_factory=dict)
+    key: Optional[str] = None
+    next: Optional[str] = None
+    invalid: str = "Invalid option. Session ended."
+    templated: bool = False
+
+
+class Outcome(NamedTuple):
+    """Result of feeding input to the menu.
+
+    Exactly one of ``state`` (prompt that state), ``end`` (END message) or
+    ``action`` (handler action) is set. ``response`` carries the
+    pre-rendered reply when it does not depend on session data.
+    """
+    state: Optional[str] = None
+    end: Optional[str] = None
+    action: Optional[str] = None
+    response: Optional[Dict[str, str]] = None
+
+
+def prerender(response_type: str, message: str) -> Dict[str, str]:
+    """Response dict with its final wire string, built once at startup.
+
+    The result is shared between requests and must not be modified.
+    """
+    return {
+        'response_type': response_type,
+        'message': message,
+        'wire': f"{response_type} {message}"
+    }
+
+
+Transition = Callable[[Dict[str, Any], str], Outcome]
+
+
+class Menu:
+    """Declarative menu compiled once into a state -> transition table"""
+    def __init__(self, states: List[State]):
+        self.states = {state.name: state for state in states}
+        for state in states:
+            targets = [state.next] + [option.next for option in state.options.values()]
+            for target in targets:
+                if target and target not in self.states:
+                    raise ValueError(f"State {state.name} leads to unknown state {target}")
+        # Entering a state; static prompts are rendered here once
+        self.entries = {
+            name: Outcome(state=name,
+                          response=None if state.templated else prerender("CON", state.prompt))
+            for name, state in self.states.items()
+        }
+        self.table: Dict[str, Transition] = {
+            name: self.compile_state(state) for name, state in self.states.items()
+        }
+
+    def compile_outcome(self, option: Option) -> Outcome:
+        if option.next:
+            return self.entries[option.next]
+        if option.end:
+            return Outcome(end=option.end, response=prerender("END", option.end))
+        return Outcome(action=option.action)
+
+    def compile_state(self, state: State) -> Transition:
+        if state.options:
+            outcomes = {key: self.compile_outcome(option)
+                        for key, option in state.options.items()}
+            values = {key: key if option.value is None else option.value
+                      for key, option in state.options.items()}
+            invalid = Outcome(end=state.invalid, response=prerender("END", state.invalid))
+
+            def choose(data: Dict[str, Any], text: str) -> Outcome:
+                outcome = outcomes.get(text)
+                if outcome is None:
+                    return invalid
+                if state.key:
+                    data[state.key] = values[text]
+                return outcome
+
+            return choose
+
+        stay = self.entries[state.name]
+        advance = self.entries[state.next]
+
+        def enter(data: Dict[str, Any], text: str) -> Outcome:
+            text = text.strip()
+            if text == "":
+                return stay
+            data[state.key] = text
+            return advance
+
+        return enter
+
+    def step(self, state: str, data: Dict[str, Any], text: str) -> Outcome:
+        """Apply one input segment at state, recording inputs in data"""
+        return self.table[state](data, text)
+
+    def run(self, entry: str, parts: List[str], data: Dict[str, Any]) -> Outcome:
+        """Replay a whole input path from an entry state"""
+        outcome = self.entries[entry]
+        for text in parts:
+            outcome = self.table[outcome.state](data, text)
+            if outcome.state is None:
+                break
+        return outcome
+
+    def prompt(self, state: str, data: Dict[str, Any]) -> str:
+        menu_state = self.states[state]
+        if menu_state.templated:
+            return menu_state.prompt.format(**data)
+        return menu_state.prompt
+
+
+USSD_MENU = Menu([
+    # New user registration
+    State('welcome', "Welcome to Yofarm Hub B2B\n1. Register\n2. Exit",
+          options={
+              '1': Option(next='name'),
+              '2': Option(end="Thank you for your interest. Goodbye."),
+          },
+          invalid="Invalid choice. Please dial again. Thank you."),
+    State('name', "Enter your full name:", key='name', next='role'),
+    State('role', "Select your role:\n1. Farmer\n2. Buyer\n3. Service Provider",
+          key='role',
+          options={
+              '1': Option(next='location', value="Farmer"),
+              '2': Option(next='location', value="Buyer"),
+              '3': Option(next='location', value="Service Provider"),
+          },
+          invalid="Invalid role selection. Session ended."),
+    State('location', "Enter your Location (District):", key='location', next='terms'),
+    State('terms', "By continuing, you agree to our Privacy Policy & Terms.\n1. Accept\n2. Decline",
+          options={
+              '1': Option(next='package'),
+              '2': Option(end="You must accept the Privacy Policy to use Yofarm Hub B2B. Thank you."),
+          },
+          invalid="Invalid input. Session ended."),
+    State('package', "Choose membership:\n1. Yofarm Access - UGX 9,999\n",
+          key='package',
+          options={
+              '1': Option(next='pay', value="Yofarm Access"),
+          },
+          invalid="Invalid package selection. Session ended."),
+    State('pay', "You selected {package}.\nPay via Mobile Money?\n1. Yes\n2. Cancel",
+          templated=True,
+          options={
+              '1': Option(action='register'),
+              '2': Option(end="Your registration was cancelled. Dial again to register."),
+          }),
+
+    # Registration awaiting or missing payment
+    State('failed', "Welcome back {name}. Your registration is incomplete.\n"
+                    "1. Retry payment for {package}\n2. Restart registration",
+          templated=True,
+          options={
+              '1': Option(action='retry_payment'),
+              '2': Option(action='restart'),
+          }),
+    State('pending', "Welcome back {name}. Your registration is incomplete.\n"
+                     "1. Confirm payment for {package}\n2. Restart registration",
+          templated=True,
+          options={
+              '1': Option(action='confirm_payment'),
+              '2': Option(action='restart'),
+          }),
+
+    # Registered members
+    State('registered', "Welcome back to Yofarm Hub B2B\n1. Buy produce or service\n2. Sell produce or service",
+          options={
+              '1': Option(end=f"Thank you for partnering with Yofarm Hub B2B. We'll get back ASAP. Inquiries: {Config.INQUIRY_PHONE}"),
+              '2': Option(end=f"Thank you for partnering with Yofarm Hub B2B. We'll get back ASAP. Inquiries: {Config.INQUIRY_PHONE}"),
+          }),
+])
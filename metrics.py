@@ -0,0 +1,364 @@
+import bisect
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Counters and histograms of exited workers, next to the per-pid snapshots
+AGGREGATE_FILE = 'aggregate.json'
+# Aggregate entry mapping each folded pid to the mtime_ns of the file folded
+RETIRED_KEY = '_retired'
+
+Labels = Tuple[str, ...]
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def samples(self) -> List[List[Any]]:
+        with self._lock:
+            return [[list(labels), value] for labels, value in self._values.items()]
+
+
+class Histogram:
+    """Cumulative-bucket latency histogram.
+
+    Histograms timed with ``time()`` take an ``outcome`` last label that is
+    filled with 'ok' or 'error'.
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (last one is +Inf), sum]
+        self._values: Dict[Labels, List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labelvalues)
+            if entry is None:
+                entry = self._values[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, *labelvalues: str) -> Iterator[None]:
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            yield
+            outcome = 'ok'
+        finally:
+            self.observe(time.perf_counter() - started, *labelvalues, outcome)
+
+    def samples(self) -> List[List[Any]]:
+        with self._lock:
+            return [[list(labels), list(counts), total]
+                    for labels, (counts, total) in self._values.items()]
+
+
+class Registry:
+    """In-process metrics, rendered in the Prometheus text format.
+
+    Under gunicorn every worker periodically writes its snapshot to
+    ``<directory>/<pid>.json``; ``render`` adds the other workers' files to
+    the live values of the process serving the scrape, so those are at
+    most one flush interval old. When a worker exits the master folds its
+    file into ``AGGREGATE_FILE`` (see ``retire_snapshot``).
+    """
+    def __init__(self):
+        self.metrics: Dict[str, Any] = {}
+        self.gauges: Dict[str, Tuple[str, Callable[[], Dict[str, Any]]]] = {}
+        self._lock = threading.Lock()
+        self._flusher: Optional[threading.Thread] = None
+
+    def _register(self, metric):
+        with self._lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets))
+
+    def register_gauges(self, prefix: str, help: str,
+                        collect: Callable[[], Dict[str, Any]]) -> None:
+        """Expose the numeric values of collect() as <prefix>_<key> gauges,
+        read at snapshot time and labelled with the process id"""
+        with self._lock:
+            self.gauges[prefix] = (help, collect)
+
+    def snapshot(self) -> Dict[str, Any]:
+        snapshot = {}
+        for metric in list(self.metrics.values()):
+            entry = {'type': metric.kind, 'help': metric.help,
+                     'labels': list(metric.labelnames), 'samples': metric.samples()}
+            if metric.kind == 'histogram':
+                entry['buckets'] = list(metric.buckets)
+            snapshot[metric.name] = entry
+
+        pid = str(os.getpid())
+        for prefix, (help, collect) in list(self.gauges.items()):
+            try:
+                values = collect()
+            except Exception as e:
+                logger.error("Metrics collector %s failed: %s", prefix, e)
+                continue
+            for key, value in values.items():
+                if isinstance(value, (bool, int, float)):
+                    snapshot[f"{prefix}_{key}"] = {'type': 'gauge', 'help': help, 'labels': ['pid'],
+                                                   'samples': [[[pid], float(value)]]}
+        return snapshot
+
+    def flush(self, directory: str) -> None:
+        """Atomically write this process's snapshot for the other workers"""
+        write_snapshot(os.path.join(directory, f"{os.getpid()}.json"), self.snapshot())
+
+    def start_flusher(self, directory: str, interval: float) -> None:
+        if self._flusher and self._flusher.is_alive():
+            return
+        os.makedirs(directory, exist_ok=True)
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.flush(directory)
+                except Exception as e:
+                    logger.error("Error writing metrics snapshot: %s", e)
+
+        self._flusher = threading.Thread(target=run, name='metrics-flusher', daemon=True)
+        self._flusher.start()
+
+    def collect(self, directory: str = '', stale_after: Optional[float] = None) -> Dict[str, Any]:
+        """Live snapshot merged with the files of the other processes.
+
+        Gauges of a worker are dropped once its file is older than
+        ``stale_after`` seconds, i.e. it stopped flushing without being
+        retired yet.
+        """
+        merged = self.snapshot()
+        if not directory:
+            return merged
+
+        # The aggregate goes first: a file retired after it was read is
+        # still merged from its own snapshot, never from both
+        aggregate_path = os.path.join(directory, AGGREGATE_FILE)
+        aggregate, _ = read_snapshot(aggregate_path)
+        retired = aggregate.pop(RETIRED_KEY, {})
+        for name, entry in aggregate.items():
+            merge_metric(merged, name, entry)
+
+        own = os.path.join(directory, f"{os.getpid()}.json")
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            if path in (own, aggregate_path):
+                continue
+            other, mtime_ns = read_snapshot(path)
+            if mtime_ns is None or retired.get(snapshot_pid(path)) == mtime_ns:
+                continue
+            stale = stale_after is not None and time.time() - mtime_ns / 1e9 > stale_after
+            for name, entry in other.items():
+                if not (stale and entry['type'] == 'gauge'):
+                    merge_metric(merged, name, entry)
+        return merged
+
+    def render(self, directory: str = '', stale_after: Optional[float] = None) -> str:
+        return render(self.collect(directory, stale_after))
+
+
+def write_snapshot(path: str, snapshot: Dict[str, Any]) -> None:
+    """Replace path atomically, so readers never see a partial file"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.metrics-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_snapshot(path: str) -> Tuple[Dict[str, Any], Optional[int]]:
+    """Return (snapshot, mtime_ns), or ({}, None) if missing or unreadable"""
+    try:
+        with open(path) as f:
+            return json.load(f), os.fstat(f.fileno()).st_mtime_ns
+    except (OSError, ValueError):
+        return {}, None
+
+
+def file_mtime_ns(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def snapshot_pid(path: str) -> str:
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def retire_snapshot(directory: str, pid: int) -> None:
+    """Fold an exited worker's counters and histograms into the aggregate
+    file and delete its snapshot.
+
+    Runs in the gunicorn master, the only writer of the aggregate. The
+    aggregate also records the folded file under ``RETIRED_KEY``, so one
+    atomic write moves the counts and ``collect`` skips the file until it
+    is deleted. Deleting keeps the directory from growing as workers are
+    recycled; a new worker that reuses the pid writes a file with another
+    mtime, which counts again.
+    """
+    path = os.path.join(directory, f"{pid}.json")
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+            mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logger.error("Dropping unreadable metrics snapshot %s: %s", path, e)
+        os.unlink(path)
+        return
+
+    aggregate_path = os.path.join(directory, AGGREGATE_FILE)
+    try:
+        with open(aggregate_path) as f:
+            aggregate = json.load(f)
+    except FileNotFoundError:
+        aggregate = {}
+    retired = aggregate.get(RETIRED_KEY, {})
+    if retired.get(str(pid)) != mtime_ns:
+        for name, entry in snapshot.items():
+            if entry['type'] != 'gauge':
+                merge_metric(aggregate, name, entry)
+
+    # Only files still on disk need skipping
+    aggregate[RETIRED_KEY] = {
+        other: other_mtime for other, other_mtime in retired.items()
+        if file_mtime_ns(os.path.join(directory, f"{other}.json")) == other_mtime}
+    aggregate[RETIRED_KEY][str(pid)] = mtime_ns
+    write_snapshot(aggregate_path, aggregate)
+    os.unlink(path)
+
+
+def merge_metric(merged: Dict[str, Any], name: str, entry: Dict[str, Any]) -> None:
+    current = merged.get(name)
+    if current is None:
+        merged[name] = entry
+        return
+    if current['type'] != entry['type'] or current.get('buckets') != entry.get('buckets'):
+        return
+
+    index = {tuple(sample[0]): sample for sample in current['samples']}
+    for sample in entry['samples']:
+        mine = index.get(tuple(sample[0]))
+        if mine is None:
+            current['samples'].append(sample)
+            index[tuple(sample[0])] = sample
+        elif entry['type'] == 'histogram':
+            mine[1] = [a + b for a, b in zip(mine[1], sample[1])]
+            mine[2] += sample[2]
+        elif entry['type'] == 'counter':
+            mine[1] += sample[1]
+
+
+def _label_text(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def render(snapshot: Dict[str, Any]) -> str:
+    """Prometheus text exposition format (version 0.0.4)"""
+    lines = []
+    for name in sorted(snapshot):
+        entry = snapshot[name]
+        lines.append(f"# HELP {name} {entry['help']}")
+        lines.append(f"# TYPE {name} {entry['type']}")
+        names = entry['labels']
+        for sample in entry['samples']:
+            values = sample[0]
+            if entry['type'] != 'histogram':
+                lines.append(f"{name}{_label_text(names, values)} {sample[1]}")
+                continue
+            cumulative = 0
+            for bound, count in zip(entry['buckets'] + ['+Inf'], sample[1]):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{name}_bucket{_label_text(names, values, le)} {cumulative}")
+            lines.append(f"{name}_sum{_label_text(names, values)} {sample[2]}")
+            lines.append(f"{name}_count{_label_text(names, values)} {cumulative}")
+    return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+USSD_REQUESTS = REGISTRY.counter(
+    'ussd_requests_total', "USSD hops answered", ('branch', 'response_type'))
+USSD_HOP_SECONDS = REGISTRY.histogram(
+    'ussd_hop_seconds', "Time to answer a USSD hop", ('branch', 'step'))
+USER_STORE_SECONDS = REGISTRY.histogram(
+    'user_store_seconds', "User storage call latency", ('op', 'outcome'))
+IOTEC_SECONDS = REGISTRY.histogram(
+    'iotec_request_seconds', "ioTec Pay HTTP request latency per attempt", ('endpoint', 'outcome'))
+
+
+_hop: ContextVar[Optional[Dict[str, str]]] = ContextVar('ussd_hop', default=None)
+
+
+def label_hop(**labels: str) -> None:
+    """Record the branch, step or response type of the hop being timed"""
+    hop = _hop.get()
+    if hop is not None:
+        hop.update(labels)
+
+
+@contextmanager
+def hop_timer() -> Iterator[Dict[str, str]]:
+    """Time a USSD hop and record it under the labels set while handling it"""
+    hop = {'branch': 'unknown', 'step': 'unknown', 'response_type': 'unknown'}
+    token = _hop.set(hop)
+    started = time.perf_counter()
+    try:
+        yield hop
+    finally:
+        _hop.reset(token)
+        USSD_HOP_SECONDS.observe(time.perf_counter() - started, hop['branch'], hop['step'])
+        USSD_REQUESTS.inc(hop['branch'], hop['response_type'])
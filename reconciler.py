@@ -0,0 +1,106 @@
+from dotenv import load_dotenv
+load_dotenv()
+
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+from config import Config
+from locks import file_lock
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class PendingReconciler:
+    """Periodically settle users stuck in 'pending' status.
+
+    Every pass lists pending users, checks their transactions with ioTec
+    in batches using a bounded thread pool and writes changed statuses
+    back per batch, skipping users whose transaction changed meanwhile. A
+    host-wide file lock plus a stamp of the last completed pass let only
+    one gunicorn worker per interval do the work.
+    """
+    def __init__(self, db_service, payment_service, interval: Optional[float] = None,
+                 batch_size: Optional[int] = None, concurrency: Optional[int] = None):
+        self.db = db_service
+        self.payment = payment_service
+        self.interval = interval or Config.RECONCILE_INTERVAL
+        self.batch_size = batch_size or Config.RECONCILE_BATCH_SIZE
+        self.concurrency = concurrency or Config.RECONCILE_CONCURRENCY
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='pending-reconciler',
+                                        daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    @property
+    def stamp_path(self) -> str:
+        return f"{Config.RECONCILE_LOCK_PATH}.last"
+
+    def last_pass_at(self) -> float:
+        """Wall-clock time of the last pass completed by any process on this host"""
+        try:
+            with open(self.stamp_path) as f:
+                return float(f.read())
+        except (OSError, ValueError):
+            return 0.0
+
+    def check_user(self, user: Dict) -> Tuple[str, Optional[str]]:
+        """Return (phone, new status) or (phone, None) if unchanged or unknown"""
+        result = self.payment.check_transaction_status(user['transaction_id'])
+        if not result['success']:
+            return user['phone'], None
+        # Intermediate ioTec statuses (e.g. Processing) must not fail the user
+        status = self.payment.map_known_status(result.get('original_status'))
+        if status is None or status == 'pending':
+            return user['phone'], None
+        return user['phone'], status
+
+    def reconcile_once(self) -> int:
+        """Run one pass and return the number of users whose status changed"""
+        with file_lock(Config.RECONCILE_LOCK_PATH, timeout=0) as acquired:
+            if not acquired:
+                logger.info("Reconciliation already running in another process")
+                return 0
+            if time.time() - self.last_pass_at() < self.interval * 0.9:
+                return 0
+
+            users = [u for u in self.db.list_users_by_status('pending')
+                     if u.get('transaction_id')]
+            changed = 0
+            with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+                for i in range(0, len(users), self.batch_size):
+                    batch = users[i:i + self.batch_size]
+                    statuses = {phone: status for phone, status in pool.map(self.check_user, batch)
+                                if status}
+                    if statuses:
+                        # Skip users who restarted or were updated since the listing
+                        transaction_ids = {u['phone']: u['transaction_id'] for u in batch}
+                        changed += self.db.update_statuses(statuses, transaction_ids)
+
+            with open(self.stamp_path, 'w') as f:
+                f.write(str(time.time()))
+            logger.info("Reconciled %s pending users, %s updated", len(users), changed)
+            return changed
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.reconcile_once()
+            except Exception as e:
+                logger.error("Reconciliation pass failed: %s", e)
+
+
+if __name__ == '__main__':
+    # One-off pass, e.g. from cron
+    from services import UserService, PaymentService
+    from storage import create_user_store
+
+    PendingReconciler(UserService(create_user_store()), PaymentService()).reconcile_once()
@@ -0,0 +1,164 @@
+import random
+import threading
+import time
+
+from collections import deque
+from typing import Optional
+
+import httpx
+import requests
+import urllib3
+
+from deadline import current_deadline
+
+
+class CircuitBreaker:
+    """Fast-fail calls to a dependency whose recent error rate is too high.
+
+    Outcomes of the last ``window`` calls are kept; once at least
+    ``min_calls`` are recorded and the failure ratio reaches
+    ``failure_rate`` the circuit opens. After ``reset_timeout`` seconds a
+    single trial call is let through and its outcome closes or re-opens it;
+    a trial that never reports back is replaced after another timeout.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, window: int, min_calls: int, failure_rate: float,
+                 reset_timeout: float):
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._trial_started = 0.0
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            now = time.monotonic()
+            if self._trial_in_flight and now - self._trial_started < self.reset_timeout:
+                return False
+            self._trial_in_flight = True
+            self._trial_started = now
+            return True
+
+    def is_open(self) -> bool:
+        """True while calls would be refused; does not use up a trial call"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                return now - self._opened_at < self.reset_timeout
+            if self.state == self.HALF_OPEN:
+                return self._trial_in_flight and now - self._trial_started < self.reset_timeout
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.CLOSED
+                self._outcomes.clear()
+                self._trial_in_flight = False
+            self._outcomes.append(True)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._open()
+                return
+            self._outcomes.append(False)
+            if len(self._outcomes) < self.min_calls:
+                return
+            failures = self._outcomes.count(False)
+            if failures / len(self._outcomes) >= self.failure_rate:
+                self._open()
+
+    def _open(self) -> None:
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._trial_in_flight = False
+
+
+def is_provider_failure(exc: Exception) -> bool:
+    """True for errors that indicate the remote service is unhealthy"""
+    if isinstance(exc, (requests.exceptions.HTTPError, httpx.HTTPStatusError)):
+        response = exc.response
+        return response is None or response.status_code >= 500
+    return isinstance(exc, (requests.exceptions.RequestException, httpx.TransportError))
+
+
+def is_connect_failure(exc: Exception) -> bool:
+    """True for errors raised before a request reached the server"""
+    if isinstance(exc, (requests.exceptions.ConnectTimeout, httpx.ConnectError,
+                        httpx.ConnectTimeout)):
+        return True
+    if isinstance(exc, requests.exceptions.ConnectionError):
+        # requests wraps urllib3's MaxRetryError, whose reason is the cause
+        reason = exc.args[0] if exc.args else None
+        reason = getattr(reason, 'reason', reason)
+        return isinstance(reason, urllib3.exceptions.NewConnectionError)
+    return False
+
+
+def may_have_been_processed(exc: Exception) -> bool:
+    """True for failures after the request may have reached the server:
+    read timeouts and connections dropped mid-request"""
+    if is_connect_failure(exc) or isinstance(exc, httpx.PoolTimeout):
+        return False
+    return isinstance(exc, (requests.exceptions.Timeout, requests.exceptions.ConnectionError,
+                            httpx.TimeoutException, httpx.NetworkError,
+                            httpx.RemoteProtocolError))
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter for transient provider errors.
+
+    Idempotent requests (status checks, token requests) are retried on
+    connection errors and gateway-style statuses. Others, i.e. collection
+    POSTs, only when ioTec cannot have processed them: failures while
+    connecting, 429 and 503. Read timeouts are never retried. Retries only
+    happen while the current USSD deadline still leaves ``min_budget``
+    seconds for another attempt after the backoff.
+    """
+    RETRYABLE_STATUSES = (429, 502, 503, 504)
+    UNPROCESSED_STATUSES = (429, 503)
+
+    def __init__(self, attempts: int, base_delay: float, max_delay: float,
+                 min_budget: float):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.min_budget = min_budget
+
+    def is_retryable(self, exc: Exception, idempotent: bool = True) -> bool:
+        if isinstance(exc, (requests.exceptions.HTTPError, httpx.HTTPStatusError)):
+            response = exc.response
+            statuses = self.RETRYABLE_STATUSES if idempotent else self.UNPROCESSED_STATUSES
+            return response is not None and response.status_code in statuses
+        if is_connect_failure(exc):
+            return True
+        # Connection dropped after the request may have been sent
+        return idempotent and isinstance(exc, (requests.exceptions.ConnectionError,
+                                               httpx.NetworkError, httpx.RemoteProtocolError))
+
+    def next_delay(self, attempt: int, exc: Exception,
+                   idempotent: bool = True) -> Optional[float]:
+        """Backoff before retry number ``attempt + 1``, or None to give up"""
+        if attempt + 1 >= self.attempts or not self.is_retryable(exc, idempotent):
+            return None
+
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        deadline = current_deadline()
+        if deadline and deadline.remaining() < delay + self.min_budget:
+            return None
+        return delay
@@ -1,16 +1,42 @@
+import hashlib
+import hmac
 import requests
 import logging
+import threading
+import time
 
-from typing import Optional, Dict, Any
+from requests.adapters import HTTPAdapter
+from typing import Optional, Dict, Any, Awaitable, List, Tuple, Union
 from dataclasses import dataclass, asdict
 from config import Config
+from cache import CountingCache
+from sessions import SessionStore, InMemorySessionStore
+from deadline import DeadlineExceeded, call_timeout, current_deadline, ensure_budget, http_timeout
+from resilience import CircuitBreaker, RetryPolicy, is_provider_failure, may_have_been_processed
+from tokens import SharedTokenCache
+from dispatch import PaymentDispatcher
+from idempotency import IdempotencyStore
+from logs import MaskedPhone
+from menu import USSD_MENU, Outcome, prerender
+from metrics import IOTEC_SECONDS, USER_STORE_SECONDS, label_hop
+from tracing import traced
+from storage import UserStore, FirestoreUserStore
 from datetime import datetime
-from db import db
-from google.cloud.firestore import Client
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Sent instead of starting a remote call the gateway would no longer wait for
+DEADLINE_RESPONSE = prerender("END", "The service is busy. Please try again.")
+
+# Answer of a flow or action method that only delegates; on AsyncUSSDHandler
+# it is the coroutine of the overridden I/O method it calls
+HopResult = Union[Dict[str, str], Awaitable[Dict[str, str]]]
+
+# Users in a status the menu has no entry for
+UNAVAILABLE_OUTCOME = Outcome(response=prerender(
+    "END", "Service temporarily unavailable. Please try again later."))
+
 
 @dataclass
 class User:
@@ -21,6 +47,7 @@ class User:
     package: str = ""
     status: str = "new"  # new, pending, failed, registered
     transaction_id: str = ""
+    external_id: str = ""
     created_at: str = ""
     updated_at: str = ""
 
@@ -31,108 +58,490 @@ class User:
 # ---------------------------
 # Services
 # ---------------------------
-class UserService:
-    """CRUD operations for user data in Firestore"""
-    def __init__(self, db_client: Client):
-        self.db = db_client
-
+class BaseUserService:
+    """Update building shared by the blocking and async user services"""
+    def __init__(self, store):
+        self.store = store
+
+    @staticmethod
+    def status_update(status: str, transaction_id: Optional[str] = None,
+                      external_id: Optional[str] = None) -> Dict[str, Any]:
+        """Fields left as None are not touched; '' clears them"""
+        update_data = {
+            'status': status,
+            'updated_at': datetime.now().isoformat()
+        }
+        if transaction_id is not None:
+            update_data['transaction_id'] = transaction_id
+        if external_id is not None:
+            update_data['external_id'] = external_id
+        return update_data
+
+
+class UserService(BaseUserService):
+    """CRUD operations for user data on a pluggable storage backend"""
+    def __init__(self, store: UserStore):
+        # A bare Firestore client is accepted for backwards compatibility
+        if not isinstance(store, UserStore):
+            store = FirestoreUserStore(store)
+        super().__init__(store)
+
+    @traced
     def get_user(self, phone: str) -> Optional[Dict[str, Any]]:
         """Retrieve user by phone number"""
         try:
-            doc_ref = self.db.collection('users').document(phone)
-            doc = doc_ref.get()
-            if doc.exists:
-                return doc.to_dict()
-            return None
+            timeout = call_timeout(Config.FIRESTORE_TIMEOUT, Config.USSD_MIN_CALL_BUDGET)
+            with USER_STORE_SECONDS.time('get'):
+                return self.store.get(phone, timeout=timeout)
+        except DeadlineExceeded:
+            raise
         except Exception as e:
-            logger.error(f"Error getting user {phone}: {e}")
+            logger.error("Error getting user %s: %s", MaskedPhone(phone), e)
+            # A lookup that timed out with the budget spent is not "no user"
+            ensure_budget(Config.USSD_MIN_CALL_BUDGET)
             return None
 
+    @traced
     def save_user(self, user_data: Dict[str, Any]) -> bool:
         """Save or update user data"""
         try:
             phone = user_data['phone']
             user_data['updated_at'] = datetime.now().isoformat()
 
-            doc_ref = self.db.collection('users').document(phone)
-            doc_ref.set(user_data, merge=True)
-            logger.info(f"User {phone} saved successfully")
+            # Writes record payment outcomes, so the hop's deadline does not cut them short
+            with USER_STORE_SECONDS.time('set'):
+                self.store.set(phone, user_data, merge=True, timeout=Config.FIRESTORE_TIMEOUT)
+            logger.info("User %s saved successfully", MaskedPhone(phone))
             return True
         except Exception as e:
-            logger.error(f"Error saving user: {e}")
+            logger.error("Error saving user: %s", e)
             return False
 
+    @traced
     def delete_user(self, phone: str) -> bool:
         """Delete user from database"""
         try:
-            doc_ref = self.db.collection('users').document(phone)
-            doc_ref.delete()
-            logger.info(f"User {phone} deleted successfully")
+            timeout = call_timeout(Config.FIRESTORE_TIMEOUT, Config.USSD_MIN_CALL_BUDGET)
+            with USER_STORE_SECONDS.time('delete'):
+                self.store.delete(phone, timeout=timeout)
+            logger.info("User %s deleted successfully", MaskedPhone(phone))
             return True
+        except DeadlineExceeded:
+            raise
         except Exception as e:
-            logger.error(f"Error deleting user {phone}: {e}")
+            logger.error("Error deleting user %s: %s", MaskedPhone(phone), e)
             return False
 
-    def update_user_status(self, phone: str, status: str, transaction_id: str = "") -> bool:
+    @traced
+    def update_user_status(self, phone: str, status: str, transaction_id: Optional[str] = None,
+                           external_id: Optional[str] = None) -> bool:
         """Update user status and transaction ID"""
         try:
-            doc_ref = self.db.collection('users').document(phone)
-            update_data = {
-                'status': status,
-                'updated_at': datetime.now().isoformat()
-            }
-            if transaction_id:
-                update_data['transaction_id'] = transaction_id
-
-            doc_ref.update(update_data)
-            logger.info(f"User {phone} status updated to {status}")
+            with USER_STORE_SECONDS.time('update'):
+                self.store.update(phone, self.status_update(status, transaction_id, external_id),
+                                  timeout=Config.FIRESTORE_TIMEOUT)
+            logger.info("User %s status updated to %s", MaskedPhone(phone), status)
             return True
         except Exception as e:
-            logger.error(f"Error updating user status: {e}")
+            logger.error("Error updating user status: %s", e)
             return False
 
+    @traced
+    def list_users_by_status(self, status: str) -> List[Dict[str, Any]]:
+        """Return all users currently in the given status"""
+        try:
+            with USER_STORE_SECONDS.time('list_by_status'):
+                return self.store.list_by_status(status)
+        except Exception as e:
+            logger.error("Error listing %s users: %s", status, e)
+            return []
 
-class PaymentService:
-    """Handle ioTec Pay payment operations"""
-    def __init__(self):
-        self.access_token = None
-        self.token_expires_at = None
+    @traced
+    def update_statuses(self, statuses: Dict[str, str],
+                        transaction_ids: Optional[Dict[str, str]] = None) -> int:
+        """Update many pending users' statuses in one batch.
 
-    def get_access_token(self) -> Optional[str]:
-        """Get OAuth2 access token from ioTec Pay"""
+        With ``transaction_ids`` a user is only updated while still pending
+        on that transaction, so a result computed from an older listing
+        never overwrites a newer registration. Returns the number updated.
+        """
         try:
-            if self.access_token and self.token_expires_at:
-                # Check if token is still valid (with 30 seconds buffer)
-                current_time = datetime.now().timestamp()
-                if current_time < (self.token_expires_at - 30):
-                    return self.access_token
-
-            # Request new token
-            headers = {'Content-Type': 'application/x-www-form-urlencoded'}
-            data = {
+            updated_at = datetime.now().isoformat()
+            match = None
+            if transaction_ids is not None:
+                match = {phone: {'status': 'pending', 'transaction_id': transaction_ids.get(phone)}
+                         for phone in statuses}
+            with USER_STORE_SECONDS.time('update_many'):
+                applied = self.store.update_many({phone: {'status': status, 'updated_at': updated_at}
+                                                  for phone, status in statuses.items()}, match)
+            logger.info("Batch updated status for %s of %s users", len(applied), len(statuses))
+            return len(applied)
+        except Exception as e:
+            logger.error("Error batch updating user statuses: %s", e)
+            return 0
+
+
+class BasePaymentService:
+    """ioTec Pay request building, response parsing and caching shared by
+    the blocking and async payment services"""
+    # Map ioTec Pay status to our internal status
+    STATUS_MAPPING = {
+        'success': 'registered',
+        'failed': 'failed',
+        'pending': 'pending',
+        'senttovendor': 'pending'
+    }
+    TERMINAL_STATUSES = ('success', 'failed')
+
+    def __init__(self, breaker: Optional[CircuitBreaker] = None,
+                 retry: Optional[RetryPolicy] = None,
+                 shared_tokens: Optional[SharedTokenCache] = None):
+        # (access_token, expires_at), replaced as one so readers never mix pairs
+        self.token: Optional[Tuple[str, float]] = None
+        if shared_tokens is None and Config.IOTEC_SHARED_TOKEN_PATH:
+            shared_tokens = SharedTokenCache(Config.IOTEC_SHARED_TOKEN_PATH)
+        self.shared_tokens = shared_tokens
+        self.status_cache = CountingCache(maxsize=Config.STATUS_CACHE_MAXSIZE, ttl=None)
+        self.pending_status_cache = CountingCache(maxsize=Config.STATUS_CACHE_MAXSIZE,
+                                                  ttl=Config.STATUS_CACHE_PENDING_TTL)
+        self.breaker = breaker or CircuitBreaker(
+            window=Config.IOTEC_BREAKER_WINDOW,
+            min_calls=Config.IOTEC_BREAKER_MIN_CALLS,
+            failure_rate=Config.IOTEC_BREAKER_FAILURE_RATE,
+            reset_timeout=Config.IOTEC_BREAKER_RESET_TIMEOUT)
+        self.retry = retry or RetryPolicy(
+            attempts=Config.IOTEC_RETRY_ATTEMPTS,
+            base_delay=Config.IOTEC_RETRY_BASE_DELAY,
+            max_delay=Config.IOTEC_RETRY_MAX_DELAY,
+            min_budget=Config.IOTEC_RETRY_MIN_BUDGET)
+
+    def is_available(self) -> bool:
+        """False while the circuit breaker would refuse a collection"""
+        return not self.breaker.is_open()
+
+    def record_outcome(self, exc: Optional[Exception] = None) -> None:
+        """Feed a call outcome to the circuit breaker"""
+        if exc is not None and is_provider_failure(exc):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+    def retry_delay(self, attempt: int, exc: Exception,
+                    idempotent: bool = True) -> Optional[float]:
+        """Backoff before retrying a failed call, or None to give up"""
+        delay = self.retry.next_delay(attempt, exc, idempotent)
+        if delay is None or not self.breaker.allow_request():
+            return None
+        logger.warning("Retrying ioTec call in %.2fs after: %s", delay, exc)
+        return delay
+
+    @property
+    def access_token(self) -> Optional[str]:
+        token = self.token
+        return token[0] if token else None
+
+    @property
+    def token_expires_at(self) -> Optional[float]:
+        token = self.token
+        return token[1] if token else None
+
+    def cached_token(self, buffer: float = 30) -> Optional[str]:
+        """Current token if it stays valid for at least ``buffer`` seconds"""
+        token = self.token
+        if token and datetime.now().timestamp() < (token[1] - buffer):
+            return token[0]
+        return None
+
+    def adopt_shared_token(self, newer_than: float = 0) -> bool:
+        """Use the host-wide token if it is valid and expires after newer_than"""
+        shared = self.shared_tokens.read()
+        if not shared:
+            return False
+
+        access_token, expires_at = shared
+        if expires_at <= newer_than or datetime.now().timestamp() >= expires_at - 30:
+            return False
+
+        self.token = (access_token, expires_at)
+        return True
+
+    @staticmethod
+    def token_request() -> Dict[str, Any]:
+        """Keyword arguments for the client credentials token request"""
+        return {
+            'headers': {'Content-Type': 'application/x-www-form-urlencoded'},
+            'data': {
                 'client_id': Config.IOTEC_CLIENT_ID,
                 'client_secret': Config.IOTEC_CLIENT_SECRET,
                 'grant_type': 'client_credentials'
             }
+        }
 
-            response = requests.post(Config.IOTEC_AUTH_URL, headers=headers, data=data)
-            response.raise_for_status()
+    def store_token(self, token_data: Dict[str, Any]) -> str:
+        expires_in = token_data.get('expires_in', 300)
+        access_token = token_data['access_token']
+        self.token = (access_token, datetime.now().timestamp() + expires_in)
+        return access_token
 
-            token_data = response.json()
-            self.access_token = token_data['access_token']
-            expires_in = token_data.get('expires_in', 300)
-            self.token_expires_at = datetime.now().timestamp() + expires_in
+    @staticmethod
+    def collection_payload(external_id: str, amount: int,
+                           payer_note: str, payee_note: str) -> Dict[str, Any]:
+        return {
+            'category': 'MobileMoney',
+            'currency': 'UGX',
+            'walletId': Config.WALLET_ID,
+            'externalId': external_id,
+            'payer': "0111777777",#formatted_phone,
+            'amount': amount,
+            'payerNote': payer_note,
+            'payeeNote': payee_note,
+            'transactionChargesCategory': 'ChargeCustomer'
+        }
 
-            logger.info("Access token obtained successfully")
+    @staticmethod
+    def collection_result(result: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'success': True,
+            'transaction_id': result.get('id'),
+            'status': result.get('status'),
+            'message': result.get('statusMessage', 'Payment request sent')
+        }
+
+    @staticmethod
+    def unknown_collection_result() -> Dict[str, Any]:
+        """A collection that timed out or was cut off after it was sent may
+        still be accepted by ioTec; its webhook is matched by externalId"""
+        return {'success': False, 'unknown': True, 'message': 'Payment outcome unknown'}
+
+    @classmethod
+    def status_result(cls, result: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            'success': True,
+            'status': cls.map_status(result.get('status')),
+            'original_status': result.get('status'),
+            'message': result.get('statusMessage', ''),
+            'amount': result.get('amount', 0)
+        }
+
+    def cached_status(self, transaction_id: str) -> Optional[Dict[str, Any]]:
+        for cache in (self.status_cache, self.pending_status_cache):
+            found, result = cache.get(transaction_id)
+            if found:
+                return dict(result)
+        return None
+
+    def store_status(self, transaction_id: str, result: Dict[str, Any]) -> None:
+        if not result['success']:
+            return
+        # Terminal statuses never change; anything else is re-checked soon
+        if (result.get('original_status') or '').lower() in self.TERMINAL_STATUSES:
+            self.status_cache.set(transaction_id, result)
+        else:
+            self.pending_status_cache.set(transaction_id, result)
+
+    def request_timeout(self, method: str, url: str) -> Tuple[float, float]:
+        """(connect, read) timeouts for one attempt.
+
+        Only idempotent reads are cut short by the hop deadline. Once a
+        collection is sent its answer is waited for, like storage writes,
+        so the outcome can be recorded even after the gateway gave up.
+        """
+        connect, read = http_timeout(Config.IOTEC_CONNECT_TIMEOUT, Config.IOTEC_READ_TIMEOUT)
+        if not self.is_idempotent(method, url):
+            read = Config.IOTEC_READ_TIMEOUT
+        return connect, read
+
+    def is_idempotent(self, method: str, url: str) -> bool:
+        """Safe to repeat: reads and token requests, but not collections"""
+        return method in ('GET', 'HEAD') or self.endpoint_name(url) == 'token'
+
+    @staticmethod
+    def endpoint_name(url: str) -> str:
+        if url == Config.IOTEC_AUTH_URL:
+            return 'token'
+        if url == Config.IOTEC_COLLECTION_URL:
+            return 'collect'
+        if url.startswith(Config.IOTEC_STATUS_URL):
+            return 'status'
+        return 'other'
+
+    @classmethod
+    def map_status(cls, status: Optional[str]) -> str:
+        return cls.STATUS_MAPPING.get((status or 'Unknown').lower(), 'failed')
+
+    @classmethod
+    def map_known_status(cls, status: Optional[str]) -> Optional[str]:
+        """Like map_status, but None for statuses not in STATUS_MAPPING"""
+        return cls.STATUS_MAPPING.get((status or '').lower())
+
+    def verify_webhook_signature(self, body: bytes, signature: str) -> bool:
+        """Check the HMAC-SHA256 signature of an ioTec status notification"""
+        if not Config.IOTEC_WEBHOOK_SECRET or not signature:
+            return False
+        expected = hmac.new(Config.IOTEC_WEBHOOK_SECRET.encode('utf-8'), body,
+                            hashlib.sha256).hexdigest()
+        return hmac.compare_digest(expected, signature.strip().lower())
+
+    @staticmethod
+    def phone_from_external_id(external_id: str) -> Optional[str]:
+        """Recover the phone from externalId values like REG_<phone>_<suffix>"""
+        parts = (external_id or '').split('_', 2)
+        if len(parts) == 3 and parts[0] in ('REG', 'RETRY') and parts[1]:
+            return parts[1]
+        return None
+
+    def format_phone_number(self, phone: str) -> Optional[str]:
+        """Format phone number to MSISDN format (256XXXXXXXXX)"""
+        try:
+            # Remove any non-digit characters
+            phone = ''.join(filter(str.isdigit, phone))
+
+            # Handle different formats
+            if phone.startswith('256') and len(phone) == 12:
+                return phone
+            elif phone.startswith('0') and len(phone) == 10:
+                return '256' + phone[1:]
+            elif len(phone) == 9:
+                return '256' + phone
+            else:
+                return None
+
+        except Exception:
+            return None
+
+
+class PaymentService(BasePaymentService):
+    """Handle ioTec Pay payment operations"""
+    def __init__(self, session: Optional[requests.Session] = None,
+                 breaker: Optional[CircuitBreaker] = None,
+                 shared_tokens: Optional[SharedTokenCache] = None,
+                 retry: Optional[RetryPolicy] = None):
+        super().__init__(breaker, retry, shared_tokens)
+        self._token_lock = threading.Lock()
+        self.session = session or self.create_session()
+
+    @staticmethod
+    def create_session() -> requests.Session:
+        """Long-lived session so ioTec connections are pooled and kept alive"""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=Config.IOTEC_POOL_CONNECTIONS,
+                              pool_maxsize=Config.IOTEC_POOL_MAXSIZE)
+        session.mount('https://', adapter)
+        return session
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Call ioTec with deadline-bounded timeouts and retries, feeding the
+        circuit breaker"""
+        attempt = 0
+        while True:
+            timeout = self.request_timeout(method, url)
+            try:
+                with IOTEC_SECONDS.time(self.endpoint_name(url)):
+                    response = self.session.request(method, url, timeout=timeout, **kwargs)
+                    response.raise_for_status()
+            except Exception as e:
+                self.record_outcome(e)
+                delay = self.retry_delay(attempt, e, self.is_idempotent(method, url))
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            self.record_outcome()
+            return response
+
+    @traced
+    def get_access_token(self) -> Optional[str]:
+        """Get OAuth2 access token from ioTec Pay.
+
+        Refresh is single-flight: while one thread fetches a new token the
+        others keep using the old one if it has not actually expired yet,
+        otherwise they wait for the refresh instead of posting their own.
+        """
+        # Check if token is still valid (with 30 seconds buffer)
+        access_token = self.cached_token()
+        if access_token:
+            return access_token
+
+        if not self._token_lock.acquire(blocking=False):
+            access_token = self.cached_token(buffer=0)
+            if access_token:
+                return access_token
+
+            deadline = current_deadline()
+            timeout = deadline.remaining() if deadline else -1
+            if not self._token_lock.acquire(timeout=timeout):
+                logger.error("Timed out waiting for access token refresh")
+                return None
+
+        try:
+            return self.cached_token() or self.fetch_token()
+        finally:
+            self._token_lock.release()
+
+    def force_refresh_token(self) -> Optional[str]:
+        """Refresh now, serialized with request-path refreshes"""
+        with self._token_lock:
+            return self.fetch_token(force=True)
+
+    def fetch_token(self, force: bool = False) -> Optional[str]:
+        """Obtain a new token, going through the host-wide cache if enabled.
+
+        With ``force`` a shared token is only adopted if another process
+        refreshed it after the one this process currently holds.
+        """
+        if not self.shared_tokens:
+            return self.refresh_access_token()
+
+        newer_than = (self.token_expires_at or 0) if force else 0
+        if not force and self.adopt_shared_token(newer_than):
             return self.access_token
 
+        deadline = current_deadline()
+        timeout = Config.IOTEC_SHARED_TOKEN_LOCK_TIMEOUT
+        if deadline:
+            timeout = min(timeout, deadline.remaining())
+
+        with self.shared_tokens.locked(timeout) as acquired:
+            if not acquired:
+                logger.error("Timed out waiting for shared token refresh")
+                return None
+
+            # Another process may have refreshed while we waited for the lock
+            if self.adopt_shared_token(newer_than):
+                return self.access_token
+
+            access_token = self.refresh_access_token()
+            if access_token:
+                self.shared_tokens.write(*self.token)
+            return access_token
+
+    @traced
+    def refresh_access_token(self) -> Optional[str]:
+        """Request a new OAuth2 access token from ioTec Pay"""
+        try:
+            response = self.request('POST', Config.IOTEC_AUTH_URL, **self.token_request())
+            access_token = self.store_token(response.json())
+
+            logger.info("Access token obtained successfully")
+            return access_token
+
+        except DeadlineExceeded:
+            raise
         except Exception as e:
-            logger.error(f"Error getting access token: {e}")
+            logger.error("Error getting access token: %s", e)
             return None
 
+    @traced
     def initiate_collection(self, phone: str, amount: int, external_id: str,
                           payer_note: str = "", payee_note: str = "") -> Dict[str, Any]:
         """Initiate mobile money collection"""
+        ensure_budget(Config.USSD_MIN_CALL_BUDGET)
+        if not self.breaker.allow_request():
+            logger.warning("Payment circuit open, skipping collection")
+            return {'success': False, 'message': 'Payment service unavailable'}
+
         try:
             access_token = self.get_access_token()
             if not access_token:
@@ -148,41 +557,46 @@ class PaymentService:
             if not formatted_phone:
                 return {'success': False, 'message': 'Invalid phone number format'}
 
-            payload = {
-                'category': 'MobileMoney',
-                'currency': 'UGX',
-                'walletId': Config.WALLET_ID,
-                'externalId': external_id,
-                'payer': "0111777777",#formatted_phone,
-                'amount': amount,
-                'payerNote': payer_note,
-                'payeeNote': payee_note,
-                'transactionChargesCategory': 'ChargeCustomer'
-            }
+            payload = self.collection_payload(external_id, amount, payer_note, payee_note)
 
-            response = requests.post(Config.IOTEC_COLLECTION_URL,
-                                   headers=headers, json=payload)
-            response.raise_for_status()
+            response = self.request('POST', Config.IOTEC_COLLECTION_URL,
+                                    headers=headers, json=payload)
 
             result = response.json()
-            logger.info(f"Collection initiated for {phone}: {result.get('id', 'N/A')}")
+            logger.info("Collection initiated for %s: %s", MaskedPhone(phone), result.get('id', 'N/A'))
 
-            return {
-                'success': True,
-                'transaction_id': result.get('id'),
-                'status': result.get('status'),
-                'message': result.get('statusMessage', 'Payment request sent')
-            }
+            return self.collection_result(result)
 
+        except DeadlineExceeded:
+            raise
         except requests.exceptions.RequestException as e:
-            logger.error(f"Payment API error: {e}")
+            if may_have_been_processed(e):
+                logger.warning("Collection for %s has an unknown outcome: %s", MaskedPhone(phone), e)
+                return self.unknown_collection_result()
+            logger.error("Payment API error: %s", e)
             return {'success': False, 'message': 'Payment service unavailable'}
         except Exception as e:
-            logger.error(f"Error initiating collection: {e}")
+            logger.error("Error initiating collection: %s", e)
             return {'success': False, 'message': 'Payment initialization failed'}
 
+    @traced
     def check_transaction_status(self, transaction_id: str) -> Dict[str, Any]:
-        """Check transaction status from ioTec Pay"""
+        """Check transaction status from ioTec Pay (cached by transaction_id)"""
+        cached = self.cached_status(transaction_id)
+        if cached:
+            return cached
+
+        result = self.fetch_transaction_status(transaction_id)
+        self.store_status(transaction_id, result)
+        return dict(result)
+
+    @traced
+    def fetch_transaction_status(self, transaction_id: str) -> Dict[str, Any]:
+        ensure_budget(Config.USSD_MIN_CALL_BUDGET)
+        if not self.breaker.allow_request():
+            logger.warning("Payment circuit open, skipping status check")
+            return {'success': False, 'message': 'Status check failed'}
+
         try:
             access_token = self.get_access_token()
             if not access_token:
@@ -191,62 +605,40 @@ class PaymentService:
             headers = {'Authorization': f'Bearer {access_token}'}
             url = f"{Config.IOTEC_STATUS_URL}/{transaction_id}"
 
-            response = requests.get(url, headers=headers)
-            response.raise_for_status()
-
-            result = response.json()
-            status = result.get('status', 'Unknown').lower()
-
-            # Map ioTec Pay status to our internal status
-            status_mapping = {
-                'success': 'registered',
-                'failed': 'failed',
-                'pending': 'pending',
-                'senttovendor': 'pending'
-            }
-
-            mapped_status = status_mapping.get(status, 'failed')
+            response = self.request('GET', url, headers=headers)
 
-            return {
-                'success': True,
-                'status': mapped_status,
-                'original_status': result.get('status'),
-                'message': result.get('statusMessage', ''),
-                'amount': result.get('amount', 0)
-            }
+            return self.status_result(response.json())
 
+        except DeadlineExceeded:
+            raise
         except requests.exceptions.RequestException as e:
-            logger.error(f"Status check API error: {e}")
+            logger.error("Status check API error: %s", e)
             return {'success': False, 'message': 'Status check failed'}
         except Exception as e:
-            logger.error(f"Error checking transaction status: {e}")
+            logger.error("Error checking transaction status: %s", e)
             return {'success': False, 'message': 'Status check failed'}
 
-    def format_phone_number(self, phone: str) -> Optional[str]:
-        """Format phone number to MSISDN format (256XXXXXXXXX)"""
-        try:
-            # Remove any non-digit characters
-            phone = ''.join(filter(str.isdigit, phone))
-
-            # Handle different formats
-            if phone.startswith('256') and len(phone) == 12:
-                return phone
-            elif phone.startswith('0') and len(phone) == 10:
-                return '256' + phone[1:]
-            elif len(phone) == 9:
-                return '256' + phone
-            else:
-                return None
-
-        except Exception:
-            return None
-
 
 class USSDHandler:
     """Handle USSD session logic and responses"""
-    def __init__(self, db_service: UserService, payment_service: PaymentService):
+    def __init__(self, db_service: UserService, payment_service: PaymentService,
+                 session_store: Optional[SessionStore] = None,
+                 dispatcher: Optional[PaymentDispatcher] = None,
+                 idempotency: Optional[IdempotencyStore] = None):
         self.db = db_service
         self.payment = payment_service
+        self.dispatcher = dispatcher
+        self.idempotency = idempotency or IdempotencyStore(
+            maxsize=Config.IDEMPOTENCY_MAXSIZE, ttl=Config.IDEMPOTENCY_TTL)
+        # Menu actions, by the names used in menu.USSD_MENU
+        self.actions = {
+            'register': self.register_action,
+            'retry_payment': self.retry_payment_action,
+            'confirm_payment': self.confirm_payment_action,
+            'restart': self.restart_action,
+        }
+        self.sessions = session_store or InMemorySessionStore(
+            maxsize=Config.SESSION_MAXSIZE, ttl=Config.SESSION_TTL)
 
     def parse_text(self, raw_text: str) -> list:
         # AT sends empty string for new session or " " sometimes; normalize to ""
@@ -258,259 +650,433 @@ class USSDHandler:
         return text.split("*")
 
     def handle_ussd_request(self, phone_number: str,
-                          text: str) -> Dict[str, str]:
+                          text: str, session_id: str = "") -> Dict[str, str]:
         """Main USSD request handler"""
+        return self.finish_request(self._handle_request(phone_number, text, session_id),
+                                   session_id)
+
+    def finish_request(self, response: Dict[str, str], session_id: str) -> Dict[str, str]:
+        """Forget the session once its last response is sent"""
+        if session_id and response['response_type'] == 'END':
+            self.sessions.delete(session_id)
+        return response
+
+    def load_session(self, phone_number: str, session_id: str) -> Dict[str, Any]:
+        """Load the user once per session and reuse the snapshot on later hops.
+
+        This snapshot is the only user caching on /ussd: a read-through
+        cache would be per process, and a session's hops and the status
+        writes of the webhook and reconciler are spread over workers.
+        """
+        session = self.cached_session(phone_number, session_id)
+        if session is None:
+            session = self.start_session(phone_number, session_id,
+                                         self.db.get_user(phone_number))
+        return session
+
+    def cached_session(self, phone_number: str, session_id: str) -> Optional[Dict[str, Any]]:
+        if session_id:
+            session = self.sessions.get(session_id)
+            if session is not None and session['phone'] == phone_number:
+                return session
+        return None
+
+    def start_session(self, phone_number: str, session_id: str,
+                      user: Optional[Dict]) -> Dict[str, Any]:
+        session = {'phone': phone_number, 'user': user}
+        if session_id:
+            self.sessions.set(session_id, session)
+        return session
+
+    def _handle_request(self, phone_number: str, text: str,
+                        session_id: str) -> Dict[str, str]:
         try:
-            parts = self.parse_text(text)
-            user = self.db.get_user(phone_number)
-
-            # Handle based on user status and session step
-            if not user or user['status'] == 'new':
-                return self.handle_new_user_flow(phone_number, parts)
-            elif user['status'] in ['pending', 'failed']:
-                return self.handle_incomplete_registration(phone_number, parts, user)
-            elif user['status'] == 'registered':
-                return self.handle_registered_user_flow(parts)
-            else:
-                return self.create_response("END", "Service temporarily unavailable. Please try again later.")
+            response = self.replayed_response(phone_number, session_id)
+            if response:
+                return response
 
-        except Exception as e:
-            logger.error(f"USSD handler error: {e}")
-            return self.create_response("END", "Service error. Please try again later.")
+            session = self.load_session(phone_number, session_id)
+            label_hop(branch=self.branch(session['user']))
 
-    def handle_new_user_flow(self, phone: str, parts: list) -> Dict[str, str]:
-        """Handle new user registration flow"""
-        # Step 0 (no input): show Welcome
-        if len(parts) == 0:
-            return self.create_response("CON",
-                "Welcome to Yofarm Hub B2B\n1. Register\n2. Exit")
-
-        # Step 1: user chose Register or Exit
-        first = parts[0]
-        if first not in ("1", "2"):
-            return self.create_response("END",
-                "Invalid choice. Please dial again. Thank you.")
+            return (self.resume_menu(session, text, session_id)
+                    or self.route(phone_number, self.parse_text(text), session['user'], session_id))
 
-        if first == "2":
-            return self.create_response("END",
-                "Thank you for your interest. Goodbye.")
-
-        # first == "1" proceed to Step 2 (enter name)
-        if len(parts) == 1:
-            return self.create_response("CON",
-                "Enter your full name:")
-
-        # Step 2: name provided
-        name = parts[1].strip()
-        if name == "":
-            return self.create_response("CON",
-                "Enter your full name:")
-
-        # Step 3: role selection
-        if len(parts) == 2:
-            return self.create_response("CON",
-                "Select your role:\n1. Farmer\n2. Buyer\n3. Service Provider")
-
-        # Step 4: user selected role
-        role_choice = parts[2]
-        roles_map = {"1": "Farmer", "2": "Buyer", "3": "Service Provider"}
-        role = roles_map.get(role_choice)
-        if not role:
-            return self.create_response("END",
-                "Invalid role selection. Session ended.")
+        except DeadlineExceeded:
+            return self.deadline_response(phone_number)
+        except Exception as e:
+            return self.error_response(e)
+
+    def replayed_response(self, phone_number: str, session_id: str) -> Optional[Dict[str, str]]:
+        """Response already given to a gateway retry of a hop that started a payment"""
+        if session_id:
+            found, response = self.idempotency.get(self.payment_key(phone_number, session_id))
+            if found:
+                label_hop(step='replay')
+                return response
+        return None
+
+    def route(self, phone_number: str, parts: list, user: Optional[Dict],
+              session_id: str = "") -> HopResult:
+        """Handle based on user status and session step"""
+        if not user or user['status'] == 'new':
+            return self.handle_new_user_flow(phone_number, parts, session_id)
+        elif user['status'] in ['pending', 'failed']:
+            return self.handle_incomplete_registration(phone_number, parts, user, session_id)
+        elif user['status'] == 'registered':
+            return self.handle_registered_user_flow(parts, session_id)
+        else:
+            return self.respond(UNAVAILABLE_OUTCOME, {}, user, session_id)
+
+    def deadline_response(self, phone_number: str) -> Dict[str, str]:
+        logger.warning("USSD deadline nearly spent for %s, asking to retry",
+                       MaskedPhone(phone_number))
+        label_hop(step='deadline')
+        return DEADLINE_RESPONSE
+
+    def error_response(self, error: Exception) -> Dict[str, str]:
+        logger.error("USSD handler error: %s", error)
+        label_hop(step='error')
+        return self.create_response("END", "Service error. Please try again later.")
+
+    @staticmethod
+    def branch(user: Optional[Dict]) -> str:
+        """Handler branch for a user record, as used in metrics"""
+        if not user or user['status'] == 'new':
+            return 'new'
+        if user['status'] in ('pending', 'failed'):
+            return 'incomplete'
+        if user['status'] == 'registered':
+            return 'registered'
+        return 'unknown'
+
+    def handle_new_user_flow(self, phone: str, parts: list,
+                             session_id: str = "") -> HopResult:
+        """Handle new user registration flow"""
+        return self.run_menu('welcome', parts, {'phone': phone}, None, session_id)
 
-        # Step 5: Enter location (district)
-        if len(parts) == 3:
-            return self.create_response("CON",
-                "Enter your Location (District):")
+    def handle_incomplete_registration(self, phone: str, parts: list, user: Dict,
+                                     session_id: str = "") -> HopResult:
+        """Handle users with pending or failed registration"""
+        data = {'phone': phone, 'name': user['name'], 'package': user['package']}
+        return self.run_menu(user['status'], parts, data, user, session_id)
 
-        location = parts[3].strip()
-        if location == "":
-            return self.create_response("CON",
-                "Enter your Location (District):")
+    def handle_registered_user_flow(self, parts: list, session_id: str = "") -> HopResult:
+        """Handle registered users"""
+        return self.run_menu('registered', parts, {}, None, session_id)
+
+    def run_menu(self, entry: str, parts: list, data: Dict[str, Any],
+                 user: Optional[Dict], session_id: str = "") -> HopResult:
+        """Walk the whole input path through the compiled menu and respond"""
+        outcome = USSD_MENU.run(entry, parts, data)
+        self.save_menu_progress(session_id, outcome, data, "*".join(parts))
+        return self.respond(outcome, data, user, session_id)
+
+    def resume_menu(self, session: Dict[str, Any], text: str,
+                    session_id: str) -> Optional[HopResult]:
+        """Apply only the newest input segment to the saved menu position.
+
+        Returns None when the session has no usable progress (first hop,
+        expired or lost state, repeated or skipped hops) so the caller
+        falls back to replaying the full path.
+        """
+        step = self.advance_menu(session, text, session_id)
+        if step is None:
+            return None
+        outcome, data = step
+        return self.respond(outcome, data, session['user'], session_id)
+
+    def advance_menu(self, session: Dict[str, Any], text: str,
+                     session_id: str) -> Optional[Tuple[Outcome, Dict[str, Any]]]:
+        """Step the saved menu position by the newest segment of text"""
+        progress = session.get('menu')
+        if not progress:
+            return None
 
-        # Step 6: Terms & Privacy acceptance
-        if len(parts) == 4:
-            return self.create_response("CON",
-                "By continuing, you agree to our Privacy Policy & Terms.\n1. Accept\n2. Decline")
+        text = (text or "").strip()
+        seen = progress['text']
+        if seen:
+            if len(text) <= len(seen) or text[len(seen)] != "*" or not text.startswith(seen):
+                return None
+            segment = text[len(seen) + 1:]
+        else:
+            segment = text
+        if not segment or "*" in segment:
+            return None
 
-        decision = parts[4]
-        if decision not in ("1", "2"):
-            return self.create_response("END",
-                "Invalid input. Session ended.")
+        data = dict(progress['data'])
+        outcome = USSD_MENU.step(progress['state'], data, segment)
+        self.save_menu_progress(session_id, outcome, data, text, session)
+        return outcome, data
+
+    def save_menu_progress(self, session_id: str, outcome: Outcome, data: Dict[str, Any],
+                           text: str, session: Optional[Dict[str, Any]] = None) -> None:
+        """Remember where the session is in the menu while it continues"""
+        if not session_id or not outcome.state:
+            return
+        session = session or self.sessions.get(session_id)
+        if session is None:
+            return
+        session['menu'] = {'state': outcome.state, 'data': data, 'text': text}
+        self.sessions.set(session_id, session)
+
+    def respond(self, outcome: Outcome, data: Dict[str, Any],
+                user: Optional[Dict], session_id: str = "") -> Dict[str, str]:
+        label_hop(step=outcome.action or outcome.state or 'end')
+        if outcome.action:
+            return self.actions[outcome.action](data, user, session_id)
+        if outcome.response:
+            return outcome.response
+        if outcome.end:
+            return self.create_response("END", outcome.end)
+        return self.create_response("CON", USSD_MENU.prompt(outcome.state, data))
+
+    def register_action(self, data: Dict[str, Any], user: Optional[Dict],
+                        session_id: str) -> HopResult:
+        new_user = User(
+            phone=data['phone'],
+            name=data['name'],
+            role=data['role'],
+            location=data['location'],
+            package=data['package'],
+        )
+        return self.initiate_payment_for_new_user(new_user, session_id)
 
-        if decision == "2":
-            # user declined terms -> end session politely
-            return self.create_response("END",
-                "You must accept the Privacy Policy to use Yofarm Hub B2B. Thank you.")
+    def retry_payment_action(self, data: Dict[str, Any], user: Optional[Dict],
+                             session_id: str) -> HopResult:
+        return self.retry_payment(user, session_id)
 
-        if len(parts) == 5:
-            packages_txt = "Choose membership:\n1. Yofarm Access - UGX 9,999\n"
-            return self.create_response("CON", packages_txt)
+    def confirm_payment_action(self, data: Dict[str, Any], user: Optional[Dict],
+                               session_id: str) -> HopResult:
+        return self.confirm_payment(user)
 
-        # Step 7: package selected
-        package_map = {"1": "Yofarm Access"}
-        pkg_choice = parts[5]
-        package = package_map.get(pkg_choice)
-        if not package:
-            return self.create_response("END",
-                "Invalid package selection. Session ended.")
+    def restart_action(self, data: Dict[str, Any], user: Optional[Dict],
+                       session_id: str) -> Dict[str, str]:
+        self.db.delete_user(data['phone'])
+        return self.restart_response()
 
-        # Ask for payment via Mobile Money
-        if len(parts) == 6:
-            return self.create_response("CON",
-                f"You selected {package}.\nPay via Mobile Money?\n1. Yes\n2. Cancel")
+    def restart_response(self) -> Dict[str, str]:
+        return self.create_response("END",
+            "Registration reset. Please redial the code to start fresh registration.")
 
-        pay_choice = parts[6]
-        if pay_choice not in ("1", "2"):
-            return self.create_response("END",
-                "Invalid option. Session ended.")
+    def payment_key(self, phone: str, session_id: str) -> str:
+        return f"{phone}:{session_id}"
 
-        if pay_choice == "2":
-            # cancel registration or treat as not paid? We'll end session politely and store as not registered
-            return self.create_response("END",
-                "Your registration was cancelled. Dial again to register.")
-
-        user = User(
-            phone=phone,
-            name=name,
-            role=role,
-            location=location,
-            package=package,
-        )
+    def external_id(self, prefix: str, phone: str, session_id: str) -> str:
+        """Stable per session, so provider-side dedupe also catches repeats"""
+        suffix = session_id or int(datetime.now().timestamp())
+        return f"{prefix}_{phone}_{suffix}"
 
-        return self.initiate_payment_for_new_user(user)
+    def initiate_payment_for_new_user(self, user: User, session_id: str = "") -> Dict[str, str]:
+        """Initiate payment for new user registration"""
+        if not session_id:
+            return self.start_new_user_payment(user, session_id)
+        return self.idempotency.run(self.payment_key(user.phone, session_id),
+                                    self.start_new_user_payment, user, session_id)
 
-    def handle_incomplete_registration(self, phone: str,
-                                     parts: list, user: Dict) -> Dict[str, str]:
-        """Handle users with pending or failed registration"""
-        if len(parts) == 0:
-            if user['status'] == 'failed':
-                option_text = f"1. Retry payment for {user['package']}"
-            else:  # pending
-                option_text = f"1. Confirm payment for {user['package']}"
+    def start_new_user_payment(self, user: User, session_id: str) -> Dict[str, str]:
+        try:
+            if self.dispatcher and not self.payment.is_available():
+                return self.payment_started_response(False)
+            charge = self.registration_charge(user.phone, user.name, session_id)
+            if self.started_in_session(self.db.get_user(user.phone), session_id, charge):
+                return self.payment_started_response(True)
+            # Record the intent first, so a lost background task, an early
+            # redial or a retry of this hop on another worker finds it
+            saved = self.db.save_user(self.payment_intent(user.to_dict(), charge))
+            if self.dispatcher:
+                return self.queue_payment(saved, self.collect_new_user_payment, user, charge)
+            return self.payment_started_response(
+                saved and self.collect_new_user_payment(user, charge))
+
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.error("Error initiating payment for new user: %s", e)
+            return self.create_response("END",
+                "Payment initialization failed. Please try again later.")
 
-            return self.create_response("CON",
-                f"Welcome back {user['name']}. Your registration is incomplete.\n{option_text}\n2. Restart registration")
+    def collect_new_user_payment(self, user: User, charge: Dict[str, Any]) -> bool:
+        """Request the registration fee and persist the new user with the outcome"""
+        fields = self.collection_fields(self.payment.initiate_collection(**charge),
+                                        charge['external_id'])
+        self.db.save_user({**user.to_dict(), **fields})
+        return fields['status'] == 'pending'
 
-        choice = parts[0]
-        if choice not in ("1", "2"):
-            return self.create_response("END",
-                "Invalid option. Session ended.")
+    def retry_payment(self, user: Dict, session_id: str = "") -> Dict[str, str]:
+        """Retry payment for failed registration"""
+        if not session_id:
+            return self.start_retry_payment(user, session_id)
+        return self.idempotency.run(self.payment_key(user['phone'], session_id),
+                                    self.start_retry_payment, user, session_id)
 
-        if choice == "2":
-            self.db.delete_user(phone)
+    def start_retry_payment(self, user: Dict, session_id: str) -> Dict[str, str]:
+        try:
+            if self.dispatcher and not self.payment.is_available():
+                return self.payment_started_response(False)
+            charge = self.registration_charge(user['phone'], user['name'], session_id, retry=True)
+            if self.started_in_session(self.db.get_user(user['phone']), session_id, charge):
+                return self.payment_started_response(True)
+            saved = self.db.save_user(self.payment_intent({'phone': user['phone']}, charge))
+            if self.dispatcher:
+                return self.queue_payment(saved, self.collect_retry_payment, user, charge)
+            return self.payment_started_response(
+                saved and self.collect_retry_payment(user, charge))
+
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            logger.error("Error retrying payment: %s", e)
             return self.create_response("END",
-                "Registration reset. Please redial the code to start fresh registration.")
-
-        if user['status'] == 'failed':
-            return self.retry_payment(user)
-        else:  # pending
-            return self.confirm_payment(user)
+                "Payment retry failed. Please try again later.")
 
-    def handle_registered_user_flow(self, parts: list) -> Dict[str, str]:
-        """Handle registered users"""
-        if len(parts) == 0:
-            return self.create_response("CON",
-                "Welcome back to Yofarm Hub B2B\n1. Buy produce or service\n2. Sell produce or service")
+    def collect_retry_payment(self, user: Dict, charge: Dict[str, Any]) -> bool:
+        """Request the fee again for a failed registration and store the outcome"""
+        fields = self.collection_fields(self.payment.initiate_collection(**charge),
+                                        charge['external_id'])
+        self.db.update_user_status(user['phone'], **fields)
+        return fields['status'] == 'pending'
+
+    def registration_charge(self, phone: str, name: str, session_id: str,
+                            retry: bool = False) -> Dict[str, Any]:
+        """initiate_collection arguments for the registration fee"""
+        if retry:
+            return {
+                'phone': phone,
+                'amount': 9999,
+                'external_id': self.external_id('RETRY', phone, session_id),
+                'payer_note': "Yofarm Hub B2B Registration Retry",
+                'payee_note': f"Registration retry for {name}"
+            }
+        return {
+            'phone': phone,
+            'amount': 9999,  # UGX 9,999
+            'external_id': self.external_id('REG', phone, session_id),
+            'payer_note': "Yofarm Hub B2B Registration",
+            'payee_note': f"Registration for {name}"
+        }
 
-        choice = parts[0]
-        if choice not in ("1", "2"):
+    @staticmethod
+    def collection_fields(payment_result: Dict[str, Any], external_id: str) -> Dict[str, str]:
+        """User fields recording the outcome of a collection request.
+
+        A collection with an unknown outcome stays pending without a
+        transaction id; the webhook adopts its id by ``external_id``.
+        """
+        if payment_result['success']:
+            return {'status': 'pending', 'external_id': external_id,
+                    'transaction_id': payment_result.get('transaction_id', '')}
+        if payment_result.get('unknown'):
+            return {'status': 'pending', 'external_id': external_id, 'transaction_id': ''}
+        return {'status': 'failed'}
+
+    def queue_payment(self, saved: bool, collect, *args) -> Dict[str, str]:
+        """Hand a collection to the dispatcher once its intent is recorded"""
+        if not saved:
+            return self.payment_started_response(False)
+        self.dispatcher.submit(collect, *args)
+        return self.payment_started_response(True)
+
+    def payment_started_response(self, started: bool) -> Dict[str, str]:
+        if started:
             return self.create_response("END",
-                "Invalid option. Session ended.")
-
+                "Payment request sent. Confirm on your phone.")
         return self.create_response("END",
-            f"Thank you for partnering with Yofarm Hub B2B. We'll get back ASAP. Inquiries: {Config.INQUIRY_PHONE}")
+            "We cannot process your payment at the moment. Please try again later.")
 
-    def initiate_payment_for_new_user(self, user: User) -> Dict[str, str]:
-        """Initiate payment for new user registration"""
+    def confirm_payment(self, user: Dict) -> Dict[str, str]:
+        """Confirm pending payment status"""
         try:
-            user_data = user.to_dict()
-
-            # Initiate payment
-            payment_result = self.payment.initiate_collection(
-                phone=user.phone,
-                amount=9999,  # UGX 9,999
-                external_id=f"REG_{user.phone}_{int(datetime.now().timestamp())}",
-                payer_note="Yofarm Hub B2B Registration",
-                payee_note=f"Registration for {user.name}"
-            )
-
-            if payment_result['success']:
-                user_data['transaction_id'] = payment_result.get('transaction_id', '')
-                user_data['status'] = 'pending'
-                self.db.save_user(user_data)
-
-                return self.create_response("END",
-                    "Payment request sent. Confirm on your phone.")
-            else:
-                user_data['status'] = 'failed'
-                self.db.save_user(user_data)
+            response = self.unpolled_payment_response(user)
+            if response:
+                return response
 
-                return self.create_response("END",
-                    "We cannot process your payment at the moment. Please try again later.")
+            status = self.checked_status(self.payment.check_transaction_status(user['transaction_id']))
+            if status:
+                self.db.update_user_status(user['phone'], status)
+            return self.checked_payment_response(user, status)
 
+        except DeadlineExceeded:
+            raise
         except Exception as e:
-            logger.error(f"Error initiating payment for new user: {e}")
+            logger.error("Error confirming payment: %s", e)
             return self.create_response("END",
-                "Payment initialization failed. Please try again later.")
+                "Payment confirmation failed. Please try again later.")
 
-    def retry_payment(self, user: Dict) -> Dict[str, str]:
-        """Retry payment for failed registration"""
-        try:
-            payment_result = self.payment.initiate_collection(
-                phone=user['phone'],
-                amount=9999,
-                external_id=f"RETRY_{user['phone']}_{int(datetime.now().timestamp())}",
-                payer_note="Yofarm Hub B2B Registration Retry",
-                payee_note=f"Registration retry for {user['name']}"
-            )
-
-            if payment_result['success']:
-                self.db.update_user_status(user['phone'], 'pending',
-                                         payment_result.get('transaction_id', ''))
-                return self.create_response("END",
-                    "Payment request sent. Confirm on your phone.")
-            else:
-                self.db.update_user_status(user['phone'], 'failed')
+    def unpolled_payment_response(self, user: Dict) -> Optional[Dict[str, str]]:
+        """Answer to a confirmation that needs no ioTec status check, if any"""
+        if not user.get('transaction_id'):
+            if self.is_payment_in_progress(user):
                 return self.create_response("END",
-                    "We cannot process your payment at the moment. Please try again later.")
-
-        except Exception as e:
-            logger.error(f"Error retrying payment: {e}")
+                    "Your payment request is being processed. Confirm again later")
             return self.create_response("END",
-                "Payment retry failed. Please try again later.")
+                "No transaction found. Please restart registration.")
 
-    def confirm_payment(self, user: Dict) -> Dict[str, str]:
-        """Confirm pending payment status"""
-        try:
-            if not user.get('transaction_id'):
-                return self.create_response("END",
-                    "No transaction found. Please restart registration.")
+        # ioTec pushes status changes to the webhook, so a recently
+        # updated pending record is current and needs no provider call
+        if Config.IOTEC_WEBHOOK_SECRET and not self.is_status_stale(user):
+            return self.create_response("END",
+                "Payment is pending. Confirm again later")
+        return None
 
-            status_result = self.payment.check_transaction_status(user['transaction_id'])
+    @staticmethod
+    def checked_status(status_result: Dict[str, Any]) -> Optional[str]:
+        """Status to store after a status check, None if it failed.
 
-            if not status_result['success']:
-                return self.create_response("END",
-                    "Unable to check payment status. Please try again later.")
-
-            new_status = status_result['status']
-            self.db.update_user_status(user['phone'], new_status)
+        Intermediate ioTec statuses (e.g. Processing) count as pending.
+        """
+        if not status_result['success']:
+            return None
+        return BasePaymentService.map_known_status(status_result.get('original_status')) or 'pending'
 
-            if new_status == 'registered':
-                return self.create_response("END",
-                    f"Thank you {user['name']}!\nYou're now registered as a {user['role']} in {user['location']}. We'll get back to you ASAP.\nInquiries: {Config.INQUIRY_PHONE}")
-            elif new_status == 'failed':
-                return self.create_response("END",
-                    "Payment failed. Try again later.")
-            else:  # still pending
-                return self.create_response("END",
-                    "Payment is pending. Confirm again later")
+    def checked_payment_response(self, user: Dict, status: Optional[str]) -> Dict[str, str]:
+        if not status:
+            return self.create_response("END",
+                "Unable to check payment status. Please try again later.")
+        return self.payment_status_response(user, status)
 
-        except Exception as e:
-            logger.error(f"Error confirming payment: {e}")
+    def payment_status_response(self, user: Dict, status: str) -> Dict[str, str]:
+        if status == 'registered':
             return self.create_response("END",
-                "Payment confirmation failed. Please try again later.")
+                f"Thank you {user['name']}!\nYou're now registered as a {user['role']} in {user['location']}. We'll get back to you ASAP.\nInquiries: {Config.INQUIRY_PHONE}")
+        elif status == 'failed':
+            return self.create_response("END",
+                "Payment failed. Try again later.")
+        else:  # still pending
+            return self.create_response("END",
+                "Payment is pending. Confirm again later")
+
+    def payment_intent(self, user_data: Dict[str, Any], charge: Dict[str, Any]) -> Dict[str, Any]:
+        """Pending record stored before a collection is requested; the
+        collection fills in the transaction id or marks it failed"""
+        return {**user_data, 'status': 'pending', 'transaction_id': '',
+                'external_id': charge['external_id']}
+
+    @staticmethod
+    def started_in_session(stored: Optional[Dict], session_id: str,
+                           charge: Dict[str, Any]) -> bool:
+        """True if the stored record shows this session's collection already
+        started, e.g. by a gateway retry of the hop served on another worker"""
+        return bool(session_id and stored and stored.get('status') == 'pending'
+                    and stored.get('external_id') == charge['external_id'])
+
+    def status_age(self, user: Dict) -> Optional[float]:
+        """Seconds since the user record was last updated, if known"""
+        try:
+            updated_at = datetime.fromisoformat(user.get('updated_at', ''))
+        except ValueError:
+            return None
+        return (datetime.now() - updated_at).total_seconds()
+
+    def is_status_stale(self, user: Dict) -> bool:
+        """True if the stored status is too old to trust without polling ioTec"""
+        age = self.status_age(user)
+        return age is None or age > Config.IOTEC_WEBHOOK_GRACE_SECONDS
+
+    def is_payment_in_progress(self, user: Dict) -> bool:
+        """True for a recorded intent whose background collection may still run"""
+        age = self.status_age(user)
+        return (user.get('status') == 'pending' and age is not None
+                and age < Config.PAYMENT_INTENT_TIMEOUT)
 
     def create_response(self, response_type: str, message: str) -> Dict[str, str]:
         """Create standardized USSD response"""
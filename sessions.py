@@ -0,0 +1,39 @@
+import threading
+
+from typing import Optional, Dict, Any
+from cachetools import TTLCache
+
+
+class SessionStore:
+    """Per-session state keyed by Africa's Talking sessionId.
+
+    Subclass to back sessions with a shared store (e.g. Redis) when
+    hops of one session can land on different hosts.
+    """
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def set(self, session_id: str, state: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+    def delete(self, session_id: str) -> None:
+        raise NotImplementedError
+
+
+class InMemorySessionStore(SessionStore):
+    """Process-local session store with TTL expiry"""
+    def __init__(self, maxsize: int, ttl: float):
+        self._sessions = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def set(self, session_id: str, state: Dict[str, Any]) -> None:
+        with self._lock:
+            self._sessions[session_id] = state
+
+    def delete(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
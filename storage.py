@@ -0,0 +1,323 @@
+import asyncio
+import copy
+import json
+import sqlite3
+import threading
+
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Optional, Dict, Any, Iterator, List
+from config import Config
+
+if TYPE_CHECKING:
+    from google.cloud.firestore import AsyncClient, Client
+
+
+class UserStore:
+    """Storage backend for user records keyed by phone number.
+
+    ``update`` raises KeyError (Firestore: NotFound) when a user does not
+    exist; ``update_many`` skips such users, and with ``match`` also those
+    whose stored fields differ, and returns the phones it updated. ``set``
+    with ``merge`` keeps fields that are not in ``data``. ``timeout`` (seconds) bounds calls to remote
+    backends; local ones ignore it.
+    """
+    def get(self, phone: str, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def set(self, phone: str, data: Dict[str, Any], merge: bool = True,
+            timeout: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    def update(self, phone: str, data: Dict[str, Any], timeout: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    def delete(self, phone: str, timeout: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    def list_by_status(self, status: str) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def update_many(self, updates: Dict[str, Dict[str, Any]],
+                    match: Optional[Dict[str, Dict[str, Any]]] = None) -> List[str]:
+        raise NotImplementedError
+
+
+class FirestoreUserStore(UserStore):
+    """Users as documents of the Firestore 'users' collection.
+
+    Without an explicit client the shared one from db.get_db() is created
+    on first use rather than at import.
+    """
+    def __init__(self, client: Optional['Client'] = None):
+        self._client = client
+
+    @property
+    def client(self) -> 'Client':
+        if self._client is None:
+            from db import get_db
+            self._client = get_db()
+        return self._client
+
+    def document(self, phone: str):
+        return self.client.collection('users').document(phone)
+
+    def get(self, phone: str, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        doc = self.document(phone).get(timeout=timeout)
+        return doc.to_dict() if doc.exists else None
+
+    def set(self, phone: str, data: Dict[str, Any], merge: bool = True,
+            timeout: Optional[float] = None) -> None:
+        self.document(phone).set(data, merge=merge, timeout=timeout)
+
+    def update(self, phone: str, data: Dict[str, Any], timeout: Optional[float] = None) -> None:
+        self.document(phone).update(data, timeout=timeout)
+
+    def delete(self, phone: str, timeout: Optional[float] = None) -> None:
+        self.document(phone).delete(timeout=timeout)
+
+    def list_by_status(self, status: str) -> List[Dict[str, Any]]:
+        from google.cloud.firestore import FieldFilter
+
+        query = self.client.collection('users').where(filter=FieldFilter('status', '==', status))
+        return [doc.to_dict() for doc in query.stream()]
+
+    def update_many(self, updates: Dict[str, Dict[str, Any]],
+                    match: Optional[Dict[str, Dict[str, Any]]] = None) -> List[str]:
+        from google.cloud.firestore import transactional
+
+        phones = list(updates)
+        applied = []
+        # Firestore caps a transaction at 500 writes
+        for i in range(0, len(phones), 500):
+            refs = {phone: self.document(phone) for phone in phones[i:i + 500]}
+
+            @transactional
+            def apply(transaction) -> List[str]:
+                done = []
+                for snapshot in transaction.get_all(list(refs.values())):
+                    phone = snapshot.id
+                    if matches(snapshot.to_dict() if snapshot.exists else None,
+                               (match or {}).get(phone)):
+                        transaction.update(refs[phone], updates[phone])
+                        done.append(phone)
+                return done
+
+            applied.extend(apply(self.client.transaction()))
+        return applied
+
+
+class InMemoryUserStore(UserStore):
+    """Process-local store for load tests and local development"""
+    def __init__(self):
+        self._users: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, phone: str, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            user = self._users.get(phone)
+            return copy.deepcopy(user) if user is not None else None
+
+    def set(self, phone: str, data: Dict[str, Any], merge: bool = True,
+            timeout: Optional[float] = None) -> None:
+        with self._lock:
+            current = self._users.get(phone, {}) if merge else {}
+            self._users[phone] = {**current, **copy.deepcopy(data)}
+
+    def update(self, phone: str, data: Dict[str, Any], timeout: Optional[float] = None) -> None:
+        with self._lock:
+            self._users[phone].update(copy.deepcopy(data))
+
+    def delete(self, phone: str, timeout: Optional[float] = None) -> None:
+        with self._lock:
+            self._users.pop(phone, None)
+
+    def list_by_status(self, status: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [copy.deepcopy(user) for user in self._users.values()
+                    if user.get('status') == status]
+
+    def update_many(self, updates: Dict[str, Dict[str, Any]],
+                    match: Optional[Dict[str, Dict[str, Any]]] = None) -> List[str]:
+        applied = []
+        with self._lock:
+            for phone, data in updates.items():
+                if matches(self._users.get(phone), (match or {}).get(phone)):
+                    self._users[phone].update(copy.deepcopy(data))
+                    applied.append(phone)
+        return applied
+
+
+class SQLiteUserStore(UserStore):
+    """Users as JSON rows in a SQLite database running in WAL mode.
+
+    Each thread gets its own connection; WAL lets readers proceed while a
+    writer commits, which suits small single-host deployments.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self.transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS users ("
+                         "phone TEXT PRIMARY KEY, status TEXT, data TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS users_status ON users (status)")
+
+    def connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=Config.SQLITE_BUSY_TIMEOUT,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Write transaction that takes the lock up front, so read-modify-write
+        sequences cannot interleave with another writer"""
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _read(self, conn: sqlite3.Connection, phone: str) -> Optional[Dict[str, Any]]:
+        row = conn.execute("SELECT data FROM users WHERE phone = ?", (phone,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _write(self, conn: sqlite3.Connection, phone: str, user: Dict[str, Any]) -> None:
+        conn.execute("INSERT OR REPLACE INTO users (phone, status, data) VALUES (?, ?, ?)",
+                     (phone, user.get('status'), json.dumps(user)))
+
+    def get(self, phone: str, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        return self._read(self.connection(), phone)
+
+    def set(self, phone: str, data: Dict[str, Any], merge: bool = True,
+            timeout: Optional[float] = None) -> None:
+        with self.transaction() as conn:
+            current = (self._read(conn, phone) or {}) if merge else {}
+            self._write(conn, phone, {**current, **data})
+
+    def update(self, phone: str, data: Dict[str, Any], timeout: Optional[float] = None) -> None:
+        with self.transaction() as conn:
+            current = self._read(conn, phone)
+            if current is None:
+                raise KeyError(phone)
+            self._write(conn, phone, {**current, **data})
+
+    def delete(self, phone: str, timeout: Optional[float] = None) -> None:
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM users WHERE phone = ?", (phone,))
+
+    def list_by_status(self, status: str) -> List[Dict[str, Any]]:
+        rows = self.connection().execute("SELECT data FROM users WHERE status = ?", (status,))
+        return [json.loads(row[0]) for row in rows]
+
+    def update_many(self, updates: Dict[str, Dict[str, Any]],
+                    match: Optional[Dict[str, Dict[str, Any]]] = None) -> List[str]:
+        applied = []
+        with self.transaction() as conn:
+            for phone, data in updates.items():
+                current = self._read(conn, phone)
+                if matches(current, (match or {}).get(phone)):
+                    self._write(conn, phone, {**current, **data})
+                    applied.append(phone)
+        return applied
+
+
+def matches(user: Optional[Dict[str, Any]], expected: Optional[Dict[str, Any]]) -> bool:
+    """True if the user exists and has every field value in expected"""
+    if user is None:
+        return False
+    return all(user.get(key) == value for key, value in (expected or {}).items())
+
+
+def create_user_store() -> UserStore:
+    """Build the backend selected by Config.STORAGE_BACKEND"""
+    backend = Config.STORAGE_BACKEND
+    if backend == 'memory':
+        return InMemoryUserStore()
+    if backend == 'sqlite':
+        return SQLiteUserStore(Config.SQLITE_PATH)
+    if backend == 'firestore':
+        return FirestoreUserStore()
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+class AsyncUserStore:
+    """Coroutine counterpart of UserStore for the async USSD path"""
+    async def get(self, phone: str, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    async def set(self, phone: str, data: Dict[str, Any], merge: bool = True,
+                  timeout: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    async def update(self, phone: str, data: Dict[str, Any], timeout: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    async def delete(self, phone: str, timeout: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+
+class AsyncFirestoreUserStore(AsyncUserStore):
+    """Users in the Firestore 'users' collection through the AsyncClient"""
+    def __init__(self, client: Optional['AsyncClient'] = None):
+        self._client = client
+
+    @property
+    def client(self) -> 'AsyncClient':
+        if self._client is None:
+            from db import get_async_db
+            self._client = get_async_db()
+        return self._client
+
+    def document(self, phone: str):
+        return self.client.collection('users').document(phone)
+
+    async def get(self, phone: str, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        doc = await self.document(phone).get(timeout=timeout)
+        return doc.to_dict() if doc.exists else None
+
+    async def set(self, phone: str, data: Dict[str, Any], merge: bool = True,
+                  timeout: Optional[float] = None) -> None:
+        await self.document(phone).set(data, merge=merge, timeout=timeout)
+
+    async def update(self, phone: str, data: Dict[str, Any], timeout: Optional[float] = None) -> None:
+        await self.document(phone).update(data, timeout=timeout)
+
+    async def delete(self, phone: str, timeout: Optional[float] = None) -> None:
+        await self.document(phone).delete(timeout=timeout)
+
+
+class ThreadedAsyncUserStore(AsyncUserStore):
+    """Run a blocking UserStore on the event loop's default thread pool"""
+    def __init__(self, store: UserStore):
+        self.store = store
+
+    async def get(self, phone: str, timeout: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        return await asyncio.to_thread(self.store.get, phone, timeout)
+
+    async def set(self, phone: str, data: Dict[str, Any], merge: bool = True,
+                  timeout: Optional[float] = None) -> None:
+        await asyncio.to_thread(self.store.set, phone, data, merge, timeout)
+
+    async def update(self, phone: str, data: Dict[str, Any], timeout: Optional[float] = None) -> None:
+        await asyncio.to_thread(self.store.update, phone, data, timeout)
+
+    async def delete(self, phone: str, timeout: Optional[float] = None) -> None:
+        await asyncio.to_thread(self.store.delete, phone, timeout)
+
+
+def create_async_user_store(store: Optional[UserStore] = None) -> AsyncUserStore:
+    """Async backend for Config.STORAGE_BACKEND.
+
+    Firestore gets its native AsyncClient; the other backends share the
+    given blocking store (or a new one) through a thread pool.
+    """
+    if Config.STORAGE_BACKEND == 'firestore':
+        return AsyncFirestoreUserStore()
+    return ThreadedAsyncUserStore(store or create_user_store())
@@ -0,0 +1,334 @@
+"""Pin the USSD screens to the hand-written flow the declarative menu replaced.
+
+``legacy_flow`` is the if/elif handler from before menu.py, reduced to
+what it answered; actions are returned by name with the fields they got.
+Every input path is checked by full replay and hop by hop through one
+session, which exercises the resumed menu state of advance_menu, on both
+the blocking and the async handler.
+"""
+import asyncio
+import random
+
+import pytest
+
+from async_services import AsyncUSSDHandler
+from config import Config
+from dispatch import AsyncPaymentDispatcher, PaymentDispatcher
+from services import USSDHandler
+
+PHONE = '256700000001'
+SENT = "Payment request sent. Confirm on your phone."
+PENDING = "Payment is pending. Confirm again later"
+RESET = "Registration reset. Please redial the code to start fresh registration."
+SEEDS = {
+    'new': None,
+    'failed': {'status': 'failed', 'transaction_id': 'T0'},
+    'pending': {'status': 'pending', 'transaction_id': 'T0'},
+    'registered': {'status': 'registered', 'transaction_id': 'T0'},
+}
+SEGMENTS = ['1', '1', '1', '2', '2', '3', '4', 'x', '', ' ', 'Ann', ' Kla ']
+
+
+def legacy_flow(user, parts):
+    """Old handler's answer: ('CON' | 'END', message) or ('action', name, fields)"""
+    if not user:
+        return legacy_new_user(parts)
+    if user['status'] in ('pending', 'failed'):
+        if len(parts) == 0:
+            verb = 'Retry' if user['status'] == 'failed' else 'Confirm'
+            return ('CON', f"Welcome back {user['name']}. Your registration is incomplete.\n"
+                           f"1. {verb} payment for {user['package']}\n2. Restart registration")
+        if parts[0] not in ('1', '2'):
+            return ('END', "Invalid option. Session ended.")
+        if parts[0] == '2':
+            return ('action', 'restart', {})
+        return ('action', 'retry_payment' if user['status'] == 'failed' else 'confirm_payment', {})
+    if len(parts) == 0:
+        return ('CON', "Welcome back to Yofarm Hub B2B\n1. Buy produce or service\n2. Sell produce or service")
+    if parts[0] not in ('1', '2'):
+        return ('END', "Invalid option. Session ended.")
+    return ('END', f"Thank you for partnering with Yofarm Hub B2B. We'll get back ASAP. Inquiries: {Config.INQUIRY_PHONE}")
+
+
+def legacy_new_user(parts):
+    if len(parts) == 0:
+        return ('CON', "Welcome to Yofarm Hub B2B\n1. Register\n2. Exit")
+    if parts[0] not in ('1', '2'):
+        return ('END', "Invalid choice. Please dial again. Thank you.")
+    if parts[0] == '2':
+        return ('END', "Thank you for your interest. Goodbye.")
+    if len(parts) == 1 or parts[1].strip() == '':
+        return ('CON', "Enter your full name:")
+    if len(parts) == 2:
+        return ('CON', "Select your role:\n1. Farmer\n2. Buyer\n3. Service Provider")
+    role = {'1': "Farmer", '2': "Buyer", '3': "Service Provider"}.get(parts[2])
+    if not role:
+        return ('END', "Invalid role selection. Session ended.")
+    if len(parts) == 3 or parts[3].strip() == '':
+        return ('CON', "Enter your Location (District):")
+    if len(parts) == 4:
+        return ('CON', "By continuing, you agree to our Privacy Policy & Terms.\n1. Accept\n2. Decline")
+    if parts[4] not in ('1', '2'):
+        return ('END', "Invalid input. Session ended.")
+    if parts[4] == '2':
+        return ('END', "You must accept the Privacy Policy to use Yofarm Hub B2B. Thank you.")
+    if len(parts) == 5:
+        return ('CON', "Choose membership:\n1. Yofarm Access - UGX 9,999\n")
+    if parts[5] != '1':
+        return ('END', "Invalid package selection. Session ended.")
+    if len(parts) == 6:
+        return ('CON', "You selected Yofarm Access.\nPay via Mobile Money?\n1. Yes\n2. Cancel")
+    if parts[6] not in ('1', '2'):
+        return ('END', "Invalid option. Session ended.")
+    if parts[6] == '2':
+        return ('END', "Your registration was cancelled. Dial again to register.")
+    return ('action', 'register', {'name': parts[1].strip(), 'role': role,
+                                   'location': parts[3].strip(), 'package': "Yofarm Access"})
+
+
+def skip_blank_answers(user, parts):
+    """Intended change: a blank name or location is consumed, and the next
+    input answers the same question instead of re-prompting forever"""
+    if user:
+        return parts
+    kept = []
+    for part in parts:
+        if kept[:1] == ['1'] and len(kept) in (1, 3) and part.strip() == '':
+            continue
+        kept.append(part)
+    return kept
+
+
+def expected(user, parts):
+    return legacy_flow(user, skip_blank_answers(user, parts))
+
+
+class FakeUserService:
+    def __init__(self, user=None):
+        self.users = {PHONE: dict(user)} if user else {}
+
+    def get_user(self, phone):
+        user = self.users.get(phone)
+        return dict(user) if user else None
+
+    def save_user(self, user_data):
+        self.users.setdefault(user_data['phone'], {}).update(user_data)
+        return True
+
+    def delete_user(self, phone):
+        self.users.pop(phone, None)
+        return True
+
+    def update_user_status(self, phone, status, transaction_id=None, external_id=None):
+        self.users[phone]['status'] = status
+        if transaction_id is not None:
+            self.users[phone]['transaction_id'] = transaction_id
+        if external_id is not None:
+            self.users[phone]['external_id'] = external_id
+        return True
+
+
+class FakePaymentService:
+    def __init__(self):
+        self.collections = []
+
+    def initiate_collection(self, **kwargs):
+        self.collections.append(kwargs)
+        return {'success': True, 'transaction_id': 'T1', 'status': 'Pending'}
+
+    def check_transaction_status(self, transaction_id):
+        return {'success': True, 'status': 'pending'}
+
+    def is_available(self):
+        return True
+
+
+class AsyncFakeUserService(FakeUserService):
+    async def get_user(self, phone):
+        return FakeUserService.get_user(self, phone)
+
+    async def save_user(self, user_data):
+        return FakeUserService.save_user(self, user_data)
+
+    async def delete_user(self, phone):
+        return FakeUserService.delete_user(self, phone)
+
+    async def update_user_status(self, phone, status, transaction_id=None, external_id=None):
+        return FakeUserService.update_user_status(self, phone, status, transaction_id, external_id)
+
+
+class AsyncFakePaymentService(FakePaymentService):
+    async def initiate_collection(self, **kwargs):
+        return FakePaymentService.initiate_collection(self, **kwargs)
+
+    async def check_transaction_status(self, transaction_id):
+        return FakePaymentService.check_transaction_status(self, transaction_id)
+
+
+class Dialer:
+    """One handler with its fakes; ``dial`` sends a hop and returns the answer"""
+    def __init__(self, mode, user=None, background=False):
+        self.mode = mode
+        if mode == 'sync':
+            self.db, self.payment = FakeUserService(user), FakePaymentService()
+            self.dispatcher = PaymentDispatcher(1) if background else None
+        else:
+            self.loop = asyncio.new_event_loop()
+            self.db, self.payment = AsyncFakeUserService(user), AsyncFakePaymentService()
+            self.dispatcher = AsyncPaymentDispatcher() if background else None
+        self.switch_worker()
+
+    def switch_worker(self):
+        """Serve the next hops from a handler that shares only the storage"""
+        handler = USSDHandler if self.mode == 'sync' else AsyncUSSDHandler
+        self.handler = handler(self.db, self.payment, dispatcher=self.dispatcher)
+
+    def dial(self, text, session_id=''):
+        if self.mode == 'sync':
+            return self.handler.handle_ussd_request(PHONE, text, session_id)
+        return self.loop.run_until_complete(
+            self.handler.handle_ussd_request(PHONE, text, session_id))
+
+    def finish_background_work(self):
+        if self.mode == 'sync':
+            self.dispatcher.shutdown(wait=True)
+            return
+        while self.dispatcher.pending:
+            self.loop.run_until_complete(asyncio.sleep(0))
+
+    def close(self):
+        if self.mode == 'async':
+            self.loop.close()
+
+
+@pytest.fixture(params=['sync', 'async'])
+def dialer(request):
+    dialers = []
+
+    def make(user=None, background=False):
+        dialers.append(Dialer(request.param, user, background))
+        return dialers[-1]
+
+    yield make
+    for made in dialers:
+        made.close()
+
+
+def seeded_user(status):
+    seed = SEEDS[status]
+    if seed is None:
+        return None
+    return {'phone': PHONE, 'name': 'Bo', 'role': 'Farmer', 'location': 'Gulu',
+            'package': 'Yofarm Access', 'updated_at': '2000-01-01T00:00:00', **seed}
+
+
+def input_paths(count=1500, seed=16):
+    rng = random.Random(seed)
+    paths = {'', '1', '1*', '1* *Ann', '1*Ann*1* ', '1*Ann*1**Kla*1*1*1', '1*Ann*1*Kla*1*1*1*9'}
+    while len(paths) < count:
+        text = '*'.join(rng.choice(SEGMENTS) for _ in range(rng.randint(1, 9)))
+        paths.add(text.strip())
+    return sorted(paths)
+
+
+def check(answer, want, db, payment):
+    if want[0] != 'action':
+        assert (answer['response_type'], answer['message']) == want
+        return
+
+    _, action, fields = want
+    assert answer['response_type'] == 'END'
+    if action == 'register':
+        assert answer['message'] == SENT
+        assert {key: db.users[PHONE][key] for key in fields} == fields
+        assert payment.collections[-1]['external_id'].startswith('REG_')
+    elif action == 'retry_payment':
+        assert answer['message'] == SENT
+        assert payment.collections[-1]['external_id'].startswith('RETRY_')
+    elif action == 'confirm_payment':
+        assert answer['message'] == PENDING
+    else:
+        assert answer['message'] == RESET
+        assert PHONE not in db.users
+
+
+def parse(text):
+    text = text.strip()
+    return text.split('*') if text else []
+
+
+@pytest.mark.parametrize('status', sorted(SEEDS))
+def test_full_replay_matches_legacy_flow(dialer, status):
+    user = seeded_user(status)
+    for text in input_paths():
+        session = dialer(user)
+        answer = session.dial(text)
+        check(answer, expected(user, parse(text)), session.db, session.payment)
+
+
+@pytest.mark.parametrize('status', sorted(SEEDS))
+def test_resumed_session_matches_legacy_flow(dialer, status):
+    user = seeded_user(status)
+    for text in input_paths():
+        session = dialer(user)
+        parts = text.split('*') if text else []
+        for hop in range(len(parts) + 1):
+            hop_text = '*'.join(parts[:hop])
+            answer = session.dial(hop_text, 'session-1')
+            check(answer, expected(user, parse(hop_text)), session.db, session.payment)
+            if answer['response_type'] == 'END':
+                break
+
+
+@pytest.mark.parametrize('hops', [
+    ['1', '1*Ann', '1*Ann'],             # gateway repeated a hop
+    ['1', '1*Ann*2*Kla'],                # hops went missing
+    ['1', '1*Ann', '2*Ann*1'],           # text no longer extends the saved text
+    ['', '1*Ann*1', '1*Ann*1*Kla*1*1'],
+])
+def test_hops_that_do_not_extend_the_session_are_replayed(dialer, hops):
+    session = dialer()
+    for text in hops:
+        answer = session.dial(text, 'session-1')
+        assert (answer['response_type'], answer['message']) == expected(None, parse(text))
+
+
+def test_blank_name_is_consumed_not_repeated(dialer):
+    # Used to stay on "Enter your full name:" whatever followed the blank
+    answer = dialer().dial('1* *Ann')
+    assert answer['message'].startswith("Select your role:")
+    assert legacy_flow(None, ['1', ' ', 'Ann']) == ('CON', "Enter your full name:")
+
+
+@pytest.mark.parametrize('status, text, prefix', [
+    ('new', '1*Ann*1*Kla*1*1*1', 'REG_'),
+    ('failed', '1', 'RETRY_'),
+])
+def test_background_payment_records_intent_first(dialer, status, text, prefix):
+    session = dialer(seeded_user(status), background=True)
+    answer = session.dial(text, 'session-1')
+    assert answer['message'] == SENT
+    assert session.db.users[PHONE]['status'] == 'pending'
+
+    session.finish_background_work()
+    assert session.payment.collections[-1]['external_id'].startswith(prefix)
+    assert session.db.users[PHONE]['transaction_id'] == 'T1'
+
+
+@pytest.mark.parametrize('status, text', [
+    ('new', '1*Ann*1*Kla*1*1*1'),
+    ('failed', '1'),
+])
+def test_hop_retried_on_another_worker_does_not_charge_again(dialer, status, text):
+    session = dialer(seeded_user(status))
+    # Earlier hops were served by one worker, which snapshotted the user
+    session.dial(text.rpartition('*')[0], 'session-1')
+    earlier = session.handler
+    session.switch_worker()
+    assert session.dial(text, 'session-1')['message'] == SENT
+
+    # The gateway retries the payment hop on the first worker
+    session.handler = earlier
+    assert session.dial(text, 'session-1')['message'] == SENT
+    assert len(session.payment.collections) == 1
+    assert session.db.users[PHONE]['transaction_id'] == 'T1'
@@ -0,0 +1,42 @@
+"""Counts from exited workers are merged exactly once while they are retired."""
+import os
+
+from metrics import Registry, retire_snapshot, write_snapshot
+
+
+def worker_snapshot(hops):
+    return {'ussd_hops_total': {'type': 'counter', 'help': "Hops", 'labels': [],
+                                'samples': [[[], hops]]}}
+
+
+def hops(directory):
+    merged = Registry().collect(str(directory))
+    return sum(sample[1] for sample in merged['ussd_hops_total']['samples'])
+
+
+def test_retired_file_still_on_disk_is_not_counted_twice(tmp_path, monkeypatch):
+    write_snapshot(str(tmp_path / '101.json'), worker_snapshot(3))
+    write_snapshot(str(tmp_path / '102.json'), worker_snapshot(4))
+
+    # A scrape between the aggregate write and the unlink
+    monkeypatch.setattr(os, 'unlink', lambda path: None)
+    retire_snapshot(str(tmp_path), 101)
+    assert (tmp_path / '101.json').exists()
+    assert hops(tmp_path) == 7
+
+    monkeypatch.undo()
+    retire_snapshot(str(tmp_path), 101)
+    assert not (tmp_path / '101.json').exists()
+    assert hops(tmp_path) == 7
+
+
+def test_new_worker_reusing_a_retired_pid_is_counted(tmp_path, monkeypatch):
+    write_snapshot(str(tmp_path / '101.json'), worker_snapshot(3))
+    monkeypatch.setattr(os, 'unlink', lambda path: None)
+    retire_snapshot(str(tmp_path), 101)
+    monkeypatch.undo()
+
+    write_snapshot(str(tmp_path / '101.json'), worker_snapshot(5))
+    assert hops(tmp_path) == 8
+    retire_snapshot(str(tmp_path), 101)
+    assert hops(tmp_path) == 8
@@ -0,0 +1,83 @@
+"""The matching rules UserStore documents, checked against each local backend.
+
+FirestoreUserStore needs a live project and is not covered here.
+"""
+import pytest
+
+from storage import InMemoryUserStore, SQLiteUserStore
+
+PHONE = '256700000001'
+OTHER = '256700000002'
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def store(request, tmp_path):
+    if request.param == 'memory':
+        return InMemoryUserStore()
+    return SQLiteUserStore(str(tmp_path / 'users.db'))
+
+
+def test_set_merges_unless_told_not_to(store):
+    store.set(PHONE, {'name': 'Ann', 'status': 'pending'})
+    store.set(PHONE, {'status': 'failed'})
+    assert store.get(PHONE) == {'name': 'Ann', 'status': 'failed'}
+
+    store.set(PHONE, {'status': 'registered'}, merge=False)
+    assert store.get(PHONE) == {'status': 'registered'}
+
+
+def test_update_keeps_other_fields(store):
+    store.set(PHONE, {'name': 'Ann', 'status': 'pending', 'transaction_id': ''})
+    store.update(PHONE, {'status': 'pending', 'transaction_id': 'T1'})
+    assert store.get(PHONE) == {'name': 'Ann', 'status': 'pending', 'transaction_id': 'T1'}
+
+
+def test_update_of_a_missing_user_raises_key_error(store):
+    with pytest.raises(KeyError):
+        store.update(PHONE, {'status': 'failed'})
+    assert store.get(PHONE) is None
+
+
+def test_update_many_skips_missing_users(store):
+    store.set(PHONE, {'status': 'pending'})
+    applied = store.update_many({PHONE: {'status': 'registered'}, OTHER: {'status': 'failed'}})
+    assert applied == [PHONE]
+    assert store.get(PHONE) == {'status': 'registered'}
+    assert store.get(OTHER) is None
+
+
+def test_update_many_skips_users_whose_fields_differ_from_match(store):
+    store.set(PHONE, {'status': 'pending', 'transaction_id': 'T1'})
+    store.set(OTHER, {'status': 'pending', 'transaction_id': 'T2'})
+    applied = store.update_many(
+        {PHONE: {'status': 'registered'}, OTHER: {'status': 'registered'}},
+        match={PHONE: {'status': 'pending', 'transaction_id': 'T1'},
+               OTHER: {'status': 'pending', 'transaction_id': 'T9'}})
+    assert applied == [PHONE]
+    assert store.get(PHONE)['status'] == 'registered'
+    assert store.get(OTHER)['status'] == 'pending'
+
+
+def test_match_on_a_field_the_user_lacks_only_matches_none(store):
+    store.set(PHONE, {'status': 'pending'})
+    assert store.update_many({PHONE: {'status': 'failed'}},
+                             match={PHONE: {'transaction_id': 'T1'}}) == []
+    assert store.update_many({PHONE: {'status': 'failed'}},
+                             match={PHONE: {'transaction_id': None}}) == [PHONE]
+
+
+def test_list_by_status_follows_updates(store):
+    store.set(PHONE, {'phone': PHONE, 'status': 'pending'})
+    store.set(OTHER, {'phone': OTHER, 'status': 'pending'})
+    store.update(OTHER, {'status': 'registered'})
+    store.update_many({PHONE: {'status': 'failed'}})
+    assert store.list_by_status('pending') == []
+    assert [user['phone'] for user in store.list_by_status('failed')] == [PHONE]
+    assert [user['phone'] for user in store.list_by_status('registered')] == [OTHER]
+
+
+def test_returned_records_are_copies(store):
+    store.set(PHONE, {'status': 'pending', 'tags': ['a']})
+    store.get(PHONE)['tags'].append('b')
+    store.list_by_status('pending')[0]['status'] = 'failed'
+    assert store.get(PHONE) == {'status': 'pending', 'tags': ['a']}
@@ -0,0 +1,119 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+from config import Config
+from locks import file_lock
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class TokenRefresher:
+    """Renew the ioTec access token ahead of expiry on a daemon thread.
+
+    The request path keeps its lazy refresh in ``get_access_token``, so if
+    this thread stops for any reason requests simply fall back to it.
+    """
+    def __init__(self, payment_service, fraction: Optional[float] = None,
+                 retry_interval: Optional[float] = None):
+        self.payment = payment_service
+        self.fraction = fraction or Config.IOTEC_TOKEN_REFRESH_FRACTION
+        self.retry_interval = retry_interval or Config.IOTEC_TOKEN_RETRY_INTERVAL
+        self.refreshes = 0
+        self.failures = 0
+        self.last_latency = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='iotec-token-refresher',
+                                        daemon=True)
+
+    @property
+    def alive(self) -> bool:
+        return self._thread.is_alive()
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'alive': self.alive,
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'last_latency': self.last_latency
+        }
+
+    def refresh_once(self) -> float:
+        """Refresh the token and return seconds to wait before the next run"""
+        started = time.monotonic()
+        token = self.payment.force_refresh_token()
+        self.last_latency = time.monotonic() - started
+
+        if not token:
+            self.failures += 1
+            logger.warning("Background token refresh failed after %.3fs", self.last_latency)
+            return self.retry_interval
+
+        self.refreshes += 1
+        logger.info("Background token refresh took %.3fs", self.last_latency)
+        lifetime = self.payment.token_expires_at - datetime.now().timestamp()
+        return max(lifetime * self.fraction, self.retry_interval)
+
+    def _run(self) -> None:
+        try:
+            while not self._stop.is_set():
+                try:
+                    wait = self.refresh_once()
+                except Exception as e:
+                    self.failures += 1
+                    logger.error("Background token refresh error: %s", e)
+                    wait = self.retry_interval
+                self._stop.wait(wait)
+        finally:
+            logger.warning("Token refresher stopped, falling back to lazy refresh")
+
+
+class SharedTokenCache:
+    """Host-wide ioTec token shared by all worker processes.
+
+    The token lives in a JSON file replaced atomically on write; an
+    exclusive ``flock`` on a sibling lock file elects the single process
+    that refreshes it while the others wait and then read the result.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+
+    def read(self) -> Optional[Tuple[str, float]]:
+        """Return (access_token, expires_at) or None if absent or unreadable"""
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            return data['access_token'], float(data['expires_at'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def write(self, access_token: str, expires_at: float) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.iotec_token')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'access_token': access_token, 'expires_at': expires_at}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.error("Error writing shared token cache: %s", e)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    def locked(self, timeout: float):
+        """Hold the host-wide refresh lock; yields False if not acquired in time"""
+        return file_lock(self.lock_path, timeout)
@@ -0,0 +1,178 @@
+import functools
+import inspect
+import json
+import logging
+import queue
+import random
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from config import Config
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    """One timed operation; spans started inside it become its children"""
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start_time',
+                 'duration', 'attributes', 'status', '_started')
+
+    def __init__(self, name: str, parent: Optional['Span'] = None,
+                 attributes: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else f"{random.getrandbits(128):032x}"
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent.span_id if parent else None
+        self.start_time = time.time()
+        self.duration: Optional[float] = None
+        self.attributes = attributes or {}
+        self.status = 'ok'
+        self._started = time.perf_counter()
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def finish(self) -> None:
+        self.duration = time.perf_counter() - self._started
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start_time': self.start_time,
+            'duration': self.duration,
+            'status': self.status,
+            'attributes': self.attributes
+        }
+
+
+class SpanExporter:
+    """Receives every finished span; must not block the caller"""
+    def export(self, span: Span) -> None:
+        raise NotImplementedError
+
+
+class InMemoryExporter(SpanExporter):
+    """Keep the most recent spans, for local debugging and load tests"""
+    def __init__(self, maxsize: int):
+        self._spans = deque(maxlen=maxsize)
+
+    def export(self, span: Span) -> None:
+        self._spans.append(span)
+
+    def spans(self, trace_id: Optional[str] = None) -> List[Span]:
+        return [span for span in list(self._spans)
+                if trace_id is None or span.trace_id == trace_id]
+
+    def clear(self) -> None:
+        self._spans.clear()
+
+
+class FileExporter(SpanExporter):
+    """Append spans as JSON lines, written by a background thread"""
+    def __init__(self, path: str):
+        self.path = path
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name='span-writer', daemon=True)
+        self._thread.start()
+
+    def export(self, span: Span) -> None:
+        self._queue.put(span)
+
+    def _run(self) -> None:
+        while True:
+            span = self._queue.get()
+            try:
+                with open(self.path, 'a') as f:
+                    f.write(json.dumps(span.to_dict(), default=str) + '\n')
+                    # Drain what queued up meanwhile with the file still open
+                    while not self._queue.empty():
+                        f.write(json.dumps(self._queue.get().to_dict(), default=str) + '\n')
+            except Exception as e:
+                logger.error("Error writing spans to %s: %s", self.path, e)
+
+
+_exporter: Optional[SpanExporter] = None
+_current_span: ContextVar[Optional[Span]] = ContextVar('current_span', default=None)
+
+
+def set_exporter(exporter: Optional[SpanExporter]) -> None:
+    """Install the span exporter; None turns tracing off"""
+    global _exporter
+    _exporter = exporter
+
+
+def get_exporter() -> Optional[SpanExporter]:
+    return _exporter
+
+
+def configure_tracing() -> Optional[SpanExporter]:
+    """Install the exporter selected by Config.TRACE_EXPORTER"""
+    if Config.TRACE_EXPORTER == 'memory':
+        set_exporter(InMemoryExporter(Config.TRACE_MEMORY_MAXSIZE))
+    elif Config.TRACE_EXPORTER == 'file':
+        set_exporter(FileExporter(Config.TRACE_FILE))
+    elif Config.TRACE_EXPORTER:
+        raise ValueError(f"Unknown trace exporter: {Config.TRACE_EXPORTER}")
+    return _exporter
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+@contextmanager
+def start_span(name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+    """Run the block inside a new child of the current span.
+
+    Yields None, at no cost beyond the check, while tracing is off.
+    """
+    exporter = _exporter
+    if exporter is None:
+        yield None
+        return
+
+    span = Span(name, _current_span.get(), attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.status = 'error'
+        span.set_attribute('error', type(e).__name__)
+        raise
+    finally:
+        _current_span.reset(token)
+        span.finish()
+        exporter.export(span)
+
+
+def traced(fn: Callable) -> Callable:
+    """Wrap every call of a function or coroutine function in a span named
+    after its qualified name"""
+    name = fn.__qualname__
+
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            if _exporter is None:
+                return await fn(*args, **kwargs)
+            with start_span(name):
+                return await fn(*args, **kwargs)
+
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if _exporter is None:
+            return fn(*args, **kwargs)
+        with start_span(name):
+            return fn(*args, **kwargs)
+
+    return wrapper